@@ -1,14 +1,16 @@
 import argparse
+import time
 import torch
 from pathlib import Path
 from typing import Dict, List, Union, Optional
-import h5py
 from types import SimpleNamespace
 import cv2
 import numpy as np
 from tqdm import tqdm
 import pprint
 import collections.abc as collections
+from collections import defaultdict
+from itertools import chain
 import PIL.Image
 import torch.nn.functional as F
 import torchvision.transforms as transforms
@@ -17,7 +19,7 @@ from . import extractors, logger
 from .utils.base_model import dynamic_load
 from .utils.tools import map_tensor
 from .utils.parsers import parse_image_lists
-from .utils.io import read_image, list_h5_names
+from .utils.io import read_image, list_h5_names, get_image_size, H5Writer
 
 
 '''
@@ -26,6 +28,10 @@ line using their name. Each is a dictionary with the following entries:
     - output: the name of the feature file that will be generated.
     - model: the model configuration, as passed to a feature extractor.
     - preprocessing: how to preprocess the images read from disk.
+    - batch_size (optional): number of images processed in a single forward
+      pass, only used by models that support batching (default: 1).
+    - num_workers (optional): number of processes that read and resize the
+      images (default: 1).
 '''
 confs = {
     'superpoint_aachen': {
@@ -279,6 +285,41 @@ class ImageDataset(torch.utils.data.Dataset):
         return len(self.names)
 
 
+class SizeBatchSampler(torch.utils.data.Sampler):
+    '''Group the images with identical original size into batches.
+       ImageDataset resizes all such images to the same size,
+       so they can be stacked without any padding.'''
+    def __init__(self, dataset: ImageDataset, batch_size: int):
+        buckets = defaultdict(list)
+        for idx, name in enumerate(dataset.names):
+            buckets[get_image_size(dataset.root / name)].append(idx)
+        self.batches = [b[i:i+batch_size] for b in buckets.values()
+                        for i in range(0, len(b), batch_size)]
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+
+def collate_by_size(samples: List[Dict]) -> List[Dict]:
+    '''Split a list of samples into batches of images with the same shape.
+       The image header can disagree with the decoded image (e.g. EXIF
+       orientation), so we do not rely on the sampler alone.'''
+    groups = defaultdict(list)
+    for data in samples:
+        groups[data['image'].shape].append(data)
+    return [torch.utils.data.dataloader.default_collate(g)
+            for g in groups.values()]
+
+
+def unbatch_predictions(pred: Dict, batch_size: int) -> List[Dict]:
+    pred = {k: v.cpu().numpy() if isinstance(v, torch.Tensor)
+            else [x.cpu().numpy() for x in v] for k, v in pred.items()}
+    return [{k: v[i] for k, v in pred.items()} for i in range(batch_size)]
+
+
 @torch.no_grad()
 def main(conf: Dict,
          image_dir: Path,
@@ -287,12 +328,14 @@ def main(conf: Dict,
          image_list: Optional[Union[Path, List[str]]] = None,
          feature_path: Optional[Path] = None,
          overwrite: bool = False,
-         use_todaygan: bool = False) -> Path:
+         use_todaygan: bool = False,
+         batch_size: Optional[int] = None,
+         num_workers: Optional[int] = None,
+         flush_interval: float = 10.) -> Path:
     logger.info('Extracting local features with configuration:'
                 f'\n{pprint.pformat(conf)}')
 
-    loader = ImageDataset(image_dir, conf['preprocessing'], image_list)
-    loader = torch.utils.data.DataLoader(loader, num_workers=1)
+    dataset = ImageDataset(image_dir, conf['preprocessing'], image_list)
 
     img_scales, ext = [1], ''
     if 'scales' in conf['preprocessing'] and \
@@ -310,71 +353,96 @@ def main(conf: Dict,
     feature_path.parent.mkdir(exist_ok=True, parents=True)
     skip_names = set(list_h5_names(feature_path)
                      if feature_path.exists() and not overwrite else ())
-    if set(loader.dataset.names).issubset(set(skip_names)):
+    if set(dataset.names).issubset(set(skip_names)):
         logger.info('Skipping the extraction.')
         return feature_path
+    dataset.names = [n for n in dataset.names if n not in skip_names]
 
     device = 'cuda' if torch.cuda.is_available() else 'cpu'
     Model = dynamic_load(extractors, conf['model']['name'])
     model = Model(conf['model']).eval().to(device)
 
-    for data in tqdm(loader):
-        name = data['name'][0]  # remove batch dimension
-        if name in skip_names:
-            continue
-
-        if use_todaygan and 'night' in name:
-            todaygan.set_input({'A': norm(data['image']), 'DA': [1], 'path': ''})
-            todaygan.test()
-            gen_img = todaygan.get_current_visuals(testing=True)['fake_0']
-            data['image'] = torch.from_numpy(gen_img / 255.).float().permute(2, 0, 1).unsqueeze(0)
-
-        if img_scales != [1]:
-            desc = []
-            for s in img_scales:
-                inp = dict(data)
-                inp['image'] = F.interpolate(inp['image'], scale_factor=s, mode='bilinear', align_corners=False)
-                desc.append(model(map_tensor(inp, lambda x: x.to(device)))['global_descriptor'])
-            desc = torch.cat(desc, 0).mean(0)
-            desc = F.normalize(desc, p=2, dim=-1)
-            pred = {'global_descriptor': desc.cpu().numpy()}
-        else:
-            pred = model(map_tensor(data, lambda x: x.to(device)))
-            pred = {k: v[0].cpu().numpy() for k, v in pred.items()}
-
-        pred['image_size'] = original_size = data['original_size'][0].numpy()
-        if 'keypoints' in pred:
-            size = np.array(data['image'].shape[-2:][::-1])
-            scales = (original_size / size).astype(np.float32)
-            pred['keypoints'] = (pred['keypoints'] + .5) * scales[None] - .5
-            # add keypoint uncertainties scaled to the original resolution
-            uncertainty = getattr(model, 'detection_noise', 1) * scales.mean()
-
-        if as_half:
-            for k in pred:
-                dt = pred[k].dtype
-                if (dt == np.float32) and (dt != np.float16):
-                    pred[k] = pred[k].astype(np.float16)
-
-        with h5py.File(str(feature_path), 'a') as fd:
-            try:
-                if name in fd:
-                    del fd[name]
-                grp = fd.create_group(name)
-                for k, v in pred.items():
-                    grp.create_dataset(k, data=v)
+    if batch_size is None:
+        batch_size = conf.get('batch_size', 1)
+    if num_workers is None:
+        num_workers = conf.get('num_workers', 1)
+    if batch_size > 1 and not Model.supports_batching:
+        logger.warning(f'Model {conf["model"]["name"]} does not support '
+                       'batching, extracting one image at a time.')
+        batch_size = 1
+    if batch_size > 1 and use_todaygan:
+        logger.warning('ToDayGAN translates one image at a time, '
+                       'extracting one image at a time.')
+        batch_size = 1
+    if batch_size > 1:
+        sampler = SizeBatchSampler(dataset, batch_size)
+    else:
+        sampler = torch.utils.data.BatchSampler(
+            torch.utils.data.SequentialSampler(dataset), 1, drop_last=False)
+    loader = torch.utils.data.DataLoader(
+        dataset, batch_sampler=sampler, num_workers=num_workers,
+        collate_fn=collate_by_size, pin_memory=(device == 'cuda'))
+
+    pbar = tqdm(total=len(dataset))
+    tic = time.time()
+    with H5Writer(feature_path, flush_interval) as writer:
+        for data in chain.from_iterable(loader):
+            if use_todaygan and 'night' in data['name'][0]:
+                todaygan.set_input(
+                    {'A': norm(data['image']), 'DA': [1], 'path': ''})
+                todaygan.test()
+                gen_img = todaygan.get_current_visuals(
+                    testing=True)['fake_0']
+                data['image'] = torch.from_numpy(gen_img / 255.).float()
+                data['image'] = data['image'].permute(2, 0, 1).unsqueeze(0)
+
+            if img_scales != [1]:
+                desc = []
+                for s in img_scales:
+                    inp = dict(data)
+                    inp['image'] = F.interpolate(
+                        inp['image'], scale_factor=s, mode='bilinear',
+                        align_corners=False)
+                    inp = map_tensor(inp, lambda x: x.to(device))
+                    desc.append(model(inp)['global_descriptor'])
+                desc = torch.stack(desc, 0).mean(0)
+                desc = F.normalize(desc, p=2, dim=-1)
+                preds = {'global_descriptor': desc}
+            else:
+                preds = model(map_tensor(data, lambda x: x.to(device)))
+            preds = unbatch_predictions(preds, len(data['name']))
+
+            for i, pred in enumerate(preds):
+                name = data['name'][i]
+                pred['image_size'] = original_size = \
+                    data['original_size'][i].numpy()
+                if 'keypoints' in pred:
+                    size = np.array(data['image'].shape[-2:][::-1])
+                    scales = (original_size / size).astype(np.float32)
+                    pred['keypoints'] = \
+                        (pred['keypoints'] + .5) * scales[None] - .5
+                    # add keypoint uncertainties scaled to the original resolution
+                    uncertainty = getattr(
+                        model, 'detection_noise', 1) * scales.mean()
+
+                if as_half:
+                    for k in pred:
+                        dt = pred[k].dtype
+                        if (dt == np.float32) and (dt != np.float16):
+                            pred[k] = pred[k].astype(np.float16)
+
+                attrs = {}
                 if 'keypoints' in pred:
-                    grp['keypoints'].attrs['uncertainty'] = uncertainty
-            except OSError as error:
-                if 'No space left on device' in error.args[0]:
-                    logger.error(
-                        'Out of disk space: storing features on disk can take '
-                        'significant space, did you enable the as_half flag?')
-                    del grp, fd[name]
-                raise error
+                    attrs['keypoints'] = {'uncertainty': uncertainty}
+                writer.write(name, pred, attrs)
 
-        del pred
+            pbar.update(len(preds))
+            del preds
+    pbar.close()
 
+    duration = time.time() - tic
+    logger.info(f'Extracted {len(dataset)} images in {duration:.1f}s '
+                f'({len(dataset) / max(duration, 1e-6):.2f} images/s).')
     logger.info('Finished exporting features.')
     return feature_path
 
@@ -388,5 +456,8 @@ if __name__ == '__main__':
     parser.add_argument('--as_half', action='store_true')
     parser.add_argument('--image_list', type=Path)
     parser.add_argument('--feature_path', type=Path)
+    parser.add_argument('--batch_size', type=int)
+    parser.add_argument('--num_workers', type=int)
     args = parser.parse_args()
-    main(confs[args.conf], args.image_dir, args.export_dir, args.as_half)
+    main(confs[args.conf], args.image_dir, args.export_dir, args.as_half,
+         batch_size=args.batch_size, num_workers=args.num_workers)
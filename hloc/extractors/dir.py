@@ -36,6 +36,7 @@ class DIR(BaseModel):
         'gemp': 3,
     }
     required_inputs = ['image']
+    supports_batching = True
 
     dir_models = {
         'Resnet-101-AP-GeM': 'https://docs.google.com/uc?export=download&id=1UWJGDuHtzaQdFhSMojoYVQjmCXhIwVvy',
@@ -67,7 +68,8 @@ class DIR(BaseModel):
         image = image / image.new_tensor(std)[:, None, None]
 
         desc = self.net(image)
-        desc = desc.unsqueeze(0)  # batch dimension
+        if desc.dim() == 1:
+            desc = desc.unsqueeze(0)  # the batch dimension is squeezed
         if self.conf['whiten_name']:
             pca = self.net.pca[self.conf['whiten_name']]
             desc = common.whiten_features(
@@ -1,4 +1,5 @@
 import sys
+import torch
 from pathlib import Path
 
 from ..utils.base_model import BaseModel
@@ -11,15 +12,20 @@ from model.students import CoarseGrainedStudent
 
 class DnS(BaseModel):
     required_inputs = ['image']
+    supports_batching = True
 
     def _init(self, conf):
         self.feat_ext = FeatureExtractor(dims=512).eval()
         self.cg_student = CoarseGrainedStudent(pretrained=True).eval()
 
     def _forward(self, data):
+        # The frame features are computed for the whole batch at once, but
+        # the student indexes its input as a video, so each image of the
+        # batch is indexed separately as a single-frame video.
         img = data['image'].permute(0, 2, 3, 1) * 255
-        desc = self.feat_ext(img).permute(1, 0, 2)
-        desc = self.cg_student.index_video(desc)
+        feats = self.feat_ext(img)
+        descs = [self.cg_student.index_video(feats[i:i+1].permute(1, 0, 2))
+                 for i in range(len(feats))]
         return {
-            'global_descriptor': desc
+            'global_descriptor': torch.cat(descs, 0)
         }
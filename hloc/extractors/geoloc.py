@@ -46,6 +46,7 @@ class RetrievalHead(nn.Module):
 
 class GeoLoc(BaseModel):
     required_inputs = ['image']
+    supports_batching = True
 
     models_urls = {
         'efficientnet': 'https://mever.iti.gr/geoloc/efficientnet.pt',
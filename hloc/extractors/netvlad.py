@@ -49,6 +49,7 @@ class NetVLAD(BaseModel):
         'whiten': True
     }
     required_inputs = ['image']
+    supports_batching = True
 
     # Models exported using
     # https://github.com/uzh-rpg/netvlad_tf_open/blob/master/matlab/net_class2struct.m.
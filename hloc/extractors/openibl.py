@@ -9,6 +9,7 @@ class OpenIBL(BaseModel):
         'model_name': 'vgg16_netvlad',
     }
     required_inputs = ['image']
+    supports_batching = True
 
     def _init(self, conf):
         self.net = torch.hub.load(
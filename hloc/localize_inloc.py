@@ -1,66 +1,87 @@
 import argparse
+import contextlib
+import multiprocessing as mp
 from pathlib import Path
+from typing import Iterable, List, Tuple
 import numpy as np
 import h5py
-from scipy.io import loadmat
 import torch
 from tqdm import tqdm
-import pickle
-import cv2
 import pycolmap
 
 from . import logger
+from .utils.io import get_image_size
 from .utils.parsers import parse_retrieval, names_to_pair
+from .utils.scan_store import ScanLoader, get_scans_dir
+from .utils.loc_logs import LocLogWriter, get_logs_path
 
 
-def interpolate_scan(scan, kp):
-    h, w, c = scan.shape
-    kp = kp / np.array([[w-1, h-1]]) * 2 - 1
-    assert np.all(kp > -1) and np.all(kp < 1)
-    scan = torch.from_numpy(scan).permute(2, 0, 1)[None]
-    kp = torch.from_numpy(kp)[None, None]
+def interpolate_scans(scans: Iterable[np.ndarray], kps: List[np.ndarray],
+                      batch_size: int = 1
+                      ) -> Tuple[List[np.ndarray], List[np.ndarray]]:
+    '''Interpolate the 3D points of keypoints in several scans at once.
+       Scans of the same size are stacked in batches of up to batch_size,
+       with their keypoints padded to the same number, and each batch is
+       sampled by one bilinear and one nearest grid_sample. Stacking copies
+       the whole scans, which costs more than the sampling for the large
+       InLoc scans, so by default each scan is its own batch: it is not
+       copied and only the pages of a memory-mapped scan around the
+       keypoints are read.'''
+    kp3ds, valids = [None] * len(kps), [None] * len(kps)
+    pending = {}  # scans waiting for a batch, by size
+    for i, (scan, kp) in enumerate(zip(scans, kps)):
+        batch = pending.setdefault(scan.shape, [])
+        batch.append((i, scan, kp))
+        if len(batch) == batch_size:
+            interpolate_batch(pending.pop(scan.shape), kp3ds, valids)
+    for batch in pending.values():
+        interpolate_batch(batch, kp3ds, valids)
+    return kp3ds, valids
+
+
+def interpolate_batch(batch: List[Tuple[int, np.ndarray, np.ndarray]],
+                      kp3ds: List, valids: List):
+    idxs, scans, kps = zip(*batch)
+    h, w, c = scans[0].shape
+    if len(scans) == 1:
+        scan = torch.from_numpy(scans[0]).permute(2, 0, 1)[None]
+    else:
+        scan = torch.from_numpy(np.stack(scans)).permute(0, 3, 1, 2)
+    grid = np.zeros((len(kps), 1, max(len(kp) for kp in kps), 2))
+    for j, kp in enumerate(kps):
+        kp = kp / np.array([[w-1, h-1]]) * 2 - 1
+        assert np.all(kp > -1) and np.all(kp < 1)
+        grid[j, 0, :len(kp)] = kp
+    grid = torch.from_numpy(grid)
+
     grid_sample = torch.nn.functional.grid_sample
+    interp_lin = grid_sample(
+        scan, grid, align_corners=True, mode='bilinear')[:, :, 0]
+    interp_nn = grid_sample(
+        scan, grid, align_corners=True, mode='nearest')[:, :, 0]
 
     # To maximize the number of points that have depth:
     # do bilinear interpolation first and then nearest for the remaining points
-    interp_lin = grid_sample(
-        scan, kp, align_corners=True, mode='bilinear')[0, :, 0]
-    interp_nn = torch.nn.functional.grid_sample(
-        scan, kp, align_corners=True, mode='nearest')[0, :, 0]
     interp = torch.where(torch.isnan(interp_lin), interp_nn, interp_lin)
-    valid = ~torch.any(torch.isnan(interp), 0)
+    valid = ~torch.any(torch.isnan(interp), 1)
 
-    kp3d = interp.T.numpy()
+    interp = interp.transpose(1, 2).numpy()
     valid = valid.numpy()
-    return kp3d, valid
+    for j, (i, kp) in enumerate(zip(idxs, kps)):
+        kp3ds[i] = interp[j, :len(kp)]
+        valids[i] = valid[j, :len(kp)]
 
 
-def get_scan_pose(dataset_dir, rpath):
-    split_image_rpath = rpath.split('/')
-    floor_name = split_image_rpath[-3]
-    scan_id = split_image_rpath[-2]
-    image_name = split_image_rpath[-1]
-    building_name = image_name[:3]
-
-    path = Path(
-        dataset_dir, 'database/alignments', floor_name,
-        f'transformations/{building_name}_trans_{scan_id}.txt')
-    with open(path) as f:
-        raw_lines = f.readlines()
-
-    P_after_GICP = np.array([
-        np.fromstring(raw_lines[7], sep=' '),
-        np.fromstring(raw_lines[8], sep=' '),
-        np.fromstring(raw_lines[9], sep=' '),
-        np.fromstring(raw_lines[10], sep=' ')
-    ])
-
-    return P_after_GICP
+def interpolate_scan(scan, kp):
+    kp3d, valid = interpolate_scans([scan], [kp])
+    return kp3d[0], valid[0]
 
 
 def pose_from_cluster(dataset_dir, q, retrieved, feature_file, match_file,
-                      skip=None):
-    height, width = cv2.imread(str(dataset_dir / q)).shape[:2]
+                      skip=None, scan_loader=None):
+    if scan_loader is None:
+        scan_loader = ScanLoader(dataset_dir, cache_size=0)
+    width, height = get_image_size(dataset_dir / q)
     cx = .5 * width
     cy = .5 * height
     focal_length = 4032. * 28. / 36.
@@ -72,6 +93,8 @@ def pose_from_cluster(dataset_dir, q, retrieved, feature_file, match_file,
     kpq = feature_file[q]['keypoints'].__array__()
     num_matches = 0
 
+    matched = []
+
     for i, r in enumerate(retrieved):
         kpr = feature_file[r]['keypoints'].__array__()
         pair = names_to_pair(q, r)
@@ -83,10 +106,13 @@ def pose_from_cluster(dataset_dir, q, retrieved, feature_file, match_file,
 
         mkpq, mkpr = kpq[v], kpr[m[v]]
         num_matches += len(mkpq)
+        matched.append((i, mkpq, mkpr))
 
-        scan_r = loadmat(Path(dataset_dir, r + '.mat'))["XYZcut"]
-        mkp3d, valid = interpolate_scan(scan_r, mkpr)
-        Tr = get_scan_pose(dataset_dir, r)
+    mkp3ds, valids = interpolate_scans(
+        (scan_loader.get_scan(retrieved[i]) for i, _, _ in matched),
+        [mkpr for _, _, mkpr in matched])
+    for (i, mkpq, mkpr), mkp3d, valid in zip(matched, mkp3ds, valids):
+        Tr = scan_loader.get_pose(retrieved[i])
         mkp3d = (Tr[:3, :3] @ mkp3d.T + Tr[:3, -1:]).T
 
         all_mkpq.append(mkpq[valid])
@@ -111,8 +137,47 @@ def pose_from_cluster(dataset_dir, q, retrieved, feature_file, match_file,
     return ret, all_mkpq, all_mkpr, all_mkp3d, all_indices, num_matches
 
 
+def localize_query(dataset_dir, q, db, feature_file, match_file,
+                   skip_matches=None, scan_loader=None):
+    if hasattr(pycolmap, 'set_random_seed'):
+        # draw the same RANSAC samples whatever the order of the queries
+        pycolmap.set_random_seed(0)
+    ret, mkpq, mkpr, mkp3d, indices, num_matches = pose_from_cluster(
+        dataset_dir, q, db, feature_file, match_file, skip_matches,
+        scan_loader)
+    log = {
+        'db': db,
+        'PnP_ret': ret,
+        'keypoints_query': mkpq,
+        'keypoints_db': mkpr,
+        '3d_points': mkp3d,
+        'indices_db': indices,
+        'num_matches': num_matches,
+    }
+    return (ret['qvec'], ret['tvec']), log
+
+
+# Read-only state shared with the forked worker processes.
+_worker_state = {}
+
+
+def _localize_worker(task):
+    state = _worker_state
+    if state.get('feature_file') is None:
+        # HDF5 files cannot be shared across processes, open them after fork
+        state['feature_file'] = h5py.File(state['features'], 'r')
+        state['match_file'] = h5py.File(state['matches'], 'r')
+        # one query per process, avoid oversubscribing the cores
+        torch.set_num_threads(1)
+    q, db = task
+    return localize_query(
+        state['dataset_dir'], q, db, state['feature_file'],
+        state['match_file'], state['skip_matches'], state['scan_loader'])
+
+
 def main(dataset_dir, retrieval, features, matches, results,
-         skip_matches=None):
+         skip_matches=None, scans_dir=None, scan_cache_size=8,
+         num_workers=1):
 
     assert retrieval.exists(), retrieval
     assert features.exists(), features
@@ -120,33 +185,52 @@ def main(dataset_dir, retrieval, features, matches, results,
 
     retrieval_dict = parse_retrieval(retrieval)
     queries = list(retrieval_dict.keys())
+    tasks = [(q, retrieval_dict[q]) for q in queries]
+
+    if scans_dir is None and get_scans_dir(dataset_dir).exists():
+        scans_dir = get_scans_dir(dataset_dir)
+    if scans_dir is None:
+        logger.info('Reading the scans from the MATLAB files, convert them '
+                    'with hloc.utils.scan_store for faster localization.')
+    # each worker process has its own cache of memory-mapped scans,
+    # whose pages are shared through the page cache of the system
+    scan_loader = ScanLoader(dataset_dir, scans_dir, scan_cache_size)
 
-    feature_file = h5py.File(features, 'r')
-    match_file = h5py.File(matches, 'r')
+    if num_workers > 1 and 'fork' not in mp.get_all_start_methods():
+        logger.warning('Parallel localization requires forking processes, '
+                       'localizing the queries sequentially.')
+        num_workers = 1
+    if num_workers > 1 and not hasattr(pycolmap, 'set_random_seed'):
+        logger.warning('This version of pycolmap cannot be seeded, RANSAC '
+                       'might draw different samples than a serial run.')
 
     poses = {}
-    logs = {
-        'features': features,
-        'matches': matches,
-        'retrieval': retrieval,
-        'loc': {},
-    }
+    logs_path = get_logs_path(results)
     logger.info('Starting localization...')
-    for q in tqdm(queries):
-        db = retrieval_dict[q]
-        ret, mkpq, mkpr, mkp3d, indices, num_matches = pose_from_cluster(
-            dataset_dir, q, db, feature_file, match_file, skip_matches)
-
-        poses[q] = (ret['qvec'], ret['tvec'])
-        logs['loc'][q] = {
-            'db': db,
-            'PnP_ret': ret,
-            'keypoints_query': mkpq,
-            'keypoints_db': mkpr,
-            '3d_points': mkp3d,
-            'indices_db': indices,
-            'num_matches': num_matches,
-        }
+    with contextlib.ExitStack() as stack:
+        log_writer = stack.enter_context(LocLogWriter(
+            logs_path, features=features, matches=matches,
+            retrieval=retrieval))
+        if num_workers > 1:
+            _worker_state.update(
+                dataset_dir=dataset_dir, features=features, matches=matches,
+                skip_matches=skip_matches, scan_loader=scan_loader)
+            stack.callback(_worker_state.clear)
+            pool = stack.enter_context(
+                mp.get_context('fork').Pool(num_workers))
+            # the results are yielded in the order of the tasks
+            outputs = pool.imap(_localize_worker, tasks)
+        else:
+            feature_file = stack.enter_context(h5py.File(features, 'r'))
+            match_file = stack.enter_context(h5py.File(matches, 'r'))
+            outputs = (localize_query(
+                dataset_dir, q, db, feature_file, match_file, skip_matches,
+                scan_loader) for q, db in tasks)
+
+        for q, (pose, log) in zip(queries, tqdm(outputs, total=len(tasks))):
+            poses[q] = pose
+            log_writer.write(q, log)
+    logger.info(f'Wrote logs to {logs_path}.')
 
     logger.info(f'Writing poses to {results}...')
     with open(results, 'w') as f:
@@ -156,11 +240,6 @@ def main(dataset_dir, retrieval, features, matches, results,
             tvec = ' '.join(map(str, tvec))
             name = q.split("/")[-1]
             f.write(f'{name} {qvec} {tvec}\n')
-
-    logs_path = f'{results}_logs.pkl'
-    logger.info(f'Writing logs to {logs_path}...')
-    with open(logs_path, 'wb') as f:
-        pickle.dump(logs, f)
     logger.info('Done!')
 
 
@@ -172,5 +251,8 @@ if __name__ == '__main__':
     parser.add_argument('--matches', type=Path, required=True)
     parser.add_argument('--results', type=Path, required=True)
     parser.add_argument('--skip_matches', type=int)
+    parser.add_argument('--scans_dir', type=Path)
+    parser.add_argument('--scan_cache_size', type=int, default=8)
+    parser.add_argument('--num_workers', type=int, default=1)
     args = parser.parse_args()
     main(**args.__dict__)
@@ -1,61 +1,37 @@
 import argparse
+import contextlib
+import multiprocessing as mp
+import time
 import numpy as np
 from pathlib import Path
-from collections import defaultdict
-from typing import Dict, List, Union
+from typing import Dict, List, Optional, Union
 from tqdm import tqdm
-import pickle
 import pycolmap
 
 from . import logger
-from .utils.io import get_keypoints, get_matches
+from .utils.io import get_keypoints, MatchReader
+from .utils.loc_logs import LocLogWriter, get_logs_path
 from .utils.parsers import parse_image_lists, parse_retrieval
+from .utils.reconstruction_index import (
+    ReconstructionIndex, load_reconstruction_index)
 
 
 def do_covisibility_clustering(frame_ids: List[int],
-                               reconstruction: pycolmap.Reconstruction):
-    clusters = []
-    visited = set()
-    for frame_id in frame_ids:
-        # Check if already labeled
-        if frame_id in visited:
-            continue
-
-        # New component
-        clusters.append([])
-        queue = {frame_id}
-        while len(queue):
-            exploration_frame = queue.pop()
-
-            # Already part of the component
-            if exploration_frame in visited:
-                continue
-            visited.add(exploration_frame)
-            clusters[-1].append(exploration_frame)
-
-            observed = reconstruction.images[exploration_frame].points2D
-            connected_frames = {
-                obs.image_id
-                for p2D in observed if p2D.has_point3D()
-                for obs in
-                reconstruction.points3D[p2D.point3D_id].track.elements
-            }
-            connected_frames &= set(frame_ids)
-            connected_frames -= visited
-            queue |= connected_frames
-
-    clusters = sorted(clusters, key=len, reverse=True)
-    return clusters
+                               index: ReconstructionIndex):
+    return index.cluster_images(frame_ids)
 
 
 class QueryLocalizer:
-    def __init__(self, reconstruction, config=None):
+    def __init__(self, reconstruction, config=None, index=None):
         self.reconstruction = reconstruction
         self.config = config or {}
+        if index is None:
+            index = ReconstructionIndex.from_reconstruction(reconstruction)
+        self.index = index
 
     def localize(self, points2D_all, points2D_idxs, points3D_id, query_camera):
         points2D = points2D_all[points2D_idxs]
-        points3D = [self.reconstruction.points3D[j].xyz for j in points3D_id]
+        points3D = self.index.get_xyz(points3D_id)
         ret = pycolmap.absolute_pose_estimation(
             points2D, points3D, query_camera,
             estimation_options=self.config.get('estimation', {}),
@@ -70,36 +46,58 @@ def pose_from_cluster(
         query_camera: pycolmap.Camera,
         db_ids: List[int],
         features_path: Path,
-        matches_path: Path,
+        matches_path: Union[Path, MatchReader],
         **kwargs):
 
     kpq = get_keypoints(features_path, qname)
     kpq += 0.5  # COLMAP coordinates
 
-    kp_idx_to_3D = defaultdict(list)
-    kp_idx_to_3D_to_db = defaultdict(lambda: defaultdict(list))
-    num_matches = 0
+    images = {}
     for i, db_id in enumerate(db_ids):
-        image = localizer.reconstruction.images[db_id]
-        if image.num_points3D() == 0:
-            logger.debug(f'No 3D points found for {image.name}.')
+        if localizer.index.num_points3D(db_id) == 0:
+            logger.debug('No 3D points found for '
+                         f'{localizer.reconstruction.images[db_id].name}.')
             continue
-        points3D_ids = np.array([p.point3D_id if p.has_point3D() else -1
-                                 for p in image.points2D])
-
-        matches, _ = get_matches(matches_path, qname, image.name)
-        matches = matches[points3D_ids[matches[:, 1]] != -1]
-        num_matches += len(matches)
-        for idx, m in matches:
-            id_3D = points3D_ids[m]
-            kp_idx_to_3D_to_db[idx][id_3D].append(i)
-            # avoid duplicate observations
-            if id_3D not in kp_idx_to_3D[idx]:
-                kp_idx_to_3D[idx].append(id_3D)
-
-    idxs = list(kp_idx_to_3D.keys())
-    mkp_idxs = [i for i in idxs for _ in kp_idx_to_3D[i]]
-    mp3d_ids = [j for i in idxs for j in kp_idx_to_3D[i]]
+        images[i] = db_id
+
+    pairs = [(qname, localizer.reconstruction.images[db_id].name)
+             for db_id in images.values()]
+    if isinstance(matches_path, MatchReader):
+        all_matches = matches_path.get_many(pairs)
+    else:
+        with MatchReader(matches_path) as reader:
+            all_matches = reader.get_many(pairs)
+
+    # Concatenate the matches to 3D points of all the images, in order.
+    kp_idxs, p3D_ids, db_idxs = ([np.zeros(0, np.int64)] for _ in range(3))
+    for (i, db_id), (matches, _) in zip(images.items(), all_matches):
+        ids = localizer.index.get_points3D_ids(db_id)[matches[:, 1]]
+        valid = ids != -1
+        kp_idxs.append(matches[valid, 0])
+        p3D_ids.append(ids[valid])
+        db_idxs.append(np.full(valid.sum(), i))
+    kp_idxs, p3D_ids, db_idxs = map(np.concatenate, (kp_idxs, p3D_ids, db_idxs))
+    num_matches = len(kp_idxs)
+
+    # Unique (keypoint, 3D point) correspondences, avoiding duplicate
+    # observations, ordered by the first occurrence of their keypoint and
+    # then by their own first occurrence.
+    _, first, inverse = np.unique(
+        np.stack([kp_idxs, p3D_ids], -1), axis=0,
+        return_index=True, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    _, kp_first, kp_inverse = np.unique(
+        kp_idxs, return_index=True, return_inverse=True)
+    kp_first = kp_first[kp_inverse.reshape(-1)]
+    order = np.lexsort((first, kp_first[first]))
+    mkp_idxs = kp_idxs[first[order]].tolist()
+    mp3d_ids = p3D_ids[first[order]].tolist()
+
+    # Database images observing each correspondence, in order.
+    db_idxs = db_idxs[np.argsort(inverse, kind='stable')].tolist()
+    ends = np.cumsum(np.bincount(inverse, minlength=len(first))).tolist()
+    starts = [0] + ends[:-1]
+
     ret = localizer.localize(kpq, mkp_idxs, mp3d_ids, query_camera, **kwargs)
     ret['camera'] = {
         'model': query_camera.model_name,
@@ -109,8 +107,8 @@ def pose_from_cluster(
     }
 
     # mostly for logging and post-processing
-    mkp_to_3D_to_db = [(j, kp_idx_to_3D_to_db[i][j])
-                       for i in idxs for j in kp_idx_to_3D[i]]
+    mkp_to_3D_to_db = [(j, db_idxs[starts[u]:ends[u]])
+                       for j, u in zip(mp3d_ids, order.tolist())]
     log = {
         'db': db_ids,
         'PnP_ret': ret,
@@ -123,6 +121,133 @@ def pose_from_cluster(
     return ret, log
 
 
+def count_matches3D(localizer: QueryLocalizer,
+                    qname: str,
+                    db_ids: List[int],
+                    match_reader: MatchReader) -> Dict[int, int]:
+    '''Number of matches of the query to the 3D points of each database
+       image, an upper bound of the number of inliers. The matches are kept
+       in the cache of the reader to not read them twice.'''
+    db_ids = [i for i in db_ids if localizer.index.num_points3D(i) > 0]
+    all_matches = match_reader.prefetch(
+        [(qname, localizer.reconstruction.images[i].name) for i in db_ids])
+    counts = {i: 0 for i in db_ids}
+    for i, (matches, _) in zip(db_ids, all_matches):
+        ids = localizer.index.get_points3D_ids(i)[matches[:, 1]]
+        counts[i] = int(np.count_nonzero(ids != -1))
+    return counts
+
+
+def rank_clusters(clusters: List[List[int]],
+                  db_ids: List[int],
+                  bounds: List[int],
+                  cluster_ranking: str) -> List[int]:
+    '''Order in which the clusters are evaluated: by decreasing number of
+       matches to 3D points or by best retrieval rank of their images.'''
+    if cluster_ranking == 'matches':
+        return sorted(range(len(clusters)), key=lambda i: -bounds[i])
+    elif cluster_ranking == 'retrieval':
+        rank = {db_id: r for r, db_id in reversed(list(enumerate(db_ids)))}
+        return sorted(range(len(clusters)),
+                      key=lambda i: min(rank[j] for j in clusters[i]))
+    raise ValueError(f'Unknown cluster ranking {cluster_ranking}, '
+                     'use matches or retrieval.')
+
+
+def localize_query(localizer: QueryLocalizer,
+                   qname: str,
+                   query_camera: pycolmap.Camera,
+                   db_ids: List[int],
+                   features_path: Path,
+                   matches_path: Union[Path, MatchReader],
+                   covisibility_clustering: bool = False,
+                   cluster_ranking: Optional[str] = None,
+                   stop_num_inliers: Optional[int] = None):
+    '''Estimate the pose of a query from its retrieved database images.
+       Return its qvec and tvec, or None if it could not be localized, and
+       its log.
+
+       With cluster_ranking, the clusters are evaluated from the most
+       promising one, and clusters with fewer matches to 3D points than the
+       current best number of inliers are skipped. With stop_num_inliers,
+       all the remaining clusters are skipped once the best one has
+       stop_num_inliers inliers.'''
+    start = time.time()
+    if hasattr(pycolmap, 'set_random_seed'):
+        # draw the same RANSAC samples whatever the order of the queries
+        pycolmap.set_random_seed(0)
+
+    if not covisibility_clustering:
+        ret, log = pose_from_cluster(
+                localizer, qname, query_camera, db_ids, features_path,
+                matches_path)
+        log['covisibility_clustering'] = covisibility_clustering
+        log['latency'] = time.time() - start
+        pose = (ret['qvec'], ret['tvec']) if ret['success'] else None
+        return pose, log
+
+    clusters = do_covisibility_clustering(db_ids, localizer.index)
+    order = range(len(clusters))
+    with contextlib.ExitStack() as stack:
+        if cluster_ranking is not None:
+            if not isinstance(matches_path, MatchReader):
+                matches_path = stack.enter_context(MatchReader(matches_path))
+            stack.callback(matches_path.clear_cache)
+            counts = count_matches3D(localizer, qname, db_ids, matches_path)
+            bounds = [sum(counts.get(j, 0) for j in c) for c in clusters]
+            order = rank_clusters(clusters, db_ids, bounds, cluster_ranking)
+
+        best_inliers = 0
+        best_cluster = None
+        logs_clusters = [None] * len(clusters)
+        skipped_clusters = []
+        for i in order:
+            if (cluster_ranking is not None and bounds[i] <= best_inliers) \
+                    or (stop_num_inliers is not None
+                        and best_inliers >= stop_num_inliers):
+                skipped_clusters.append(i)
+                continue
+            ret, log = pose_from_cluster(
+                    localizer, qname, query_camera, clusters[i],
+                    features_path, matches_path)
+            if ret['success'] and ret['num_inliers'] > best_inliers:
+                best_cluster = i
+                best_inliers = ret['num_inliers']
+            logs_clusters[i] = log
+
+    pose = None
+    if best_cluster is not None:
+        ret = logs_clusters[best_cluster]['PnP_ret']
+        pose = (ret['qvec'], ret['tvec'])
+    log = {
+        'db': db_ids,
+        'best_cluster': best_cluster,
+        'log_clusters': logs_clusters,
+        'covisibility_clustering': covisibility_clustering,
+        'skipped_clusters': sorted(skipped_clusters),
+        'latency': time.time() - start,
+    }
+    return pose, log
+
+
+# State of the worker processes, inherited from the parent when they are
+# forked such that the reconstruction is shared and not reloaded.
+_worker_state = {}
+
+
+def _localize_worker(task):
+    state = _worker_state
+    if state.get('match_reader') is None:
+        # HDF5 files cannot be shared across processes, open them after fork
+        state['match_reader'] = MatchReader(state['matches'])
+    idx, db_ids = task
+    qname, qcam = state['queries'][idx]
+    return localize_query(
+        state['localizer'], qname, qcam, db_ids, state['features'],
+        state['match_reader'], state['covisibility_clustering'],
+        state['cluster_ranking'], state['stop_num_inliers'])
+
+
 def main(reference_sfm: Union[Path, pycolmap.Reconstruction],
          queries: Path,
          retrieval: Path,
@@ -132,7 +257,10 @@ def main(reference_sfm: Union[Path, pycolmap.Reconstruction],
          ransac_thresh: int = 12,
          covisibility_clustering: bool = False,
          prepend_camera_name: bool = False,
-         config: Dict = None):
+         config: Dict = None,
+         num_workers: int = 1,
+         cluster_ranking: Optional[str] = None,
+         stop_num_inliers: Optional[int] = None):
 
     assert retrieval.exists(), retrieval
     assert features.exists(), features
@@ -142,23 +270,19 @@ def main(reference_sfm: Union[Path, pycolmap.Reconstruction],
     retrieval_dict = parse_retrieval(retrieval)
 
     logger.info('Reading the 3D model...')
-    if not isinstance(reference_sfm, pycolmap.Reconstruction):
+    if isinstance(reference_sfm, pycolmap.Reconstruction):
+        index = ReconstructionIndex.from_reconstruction(reference_sfm)
+    else:
+        index = load_reconstruction_index(reference_sfm)
         reference_sfm = pycolmap.Reconstruction(reference_sfm)
     db_name_to_id = {img.name: i for i, img in reference_sfm.images.items()}
 
     config = {"estimation": {"ransac": {"max_error": ransac_thresh}},
               **(config or {})}
-    localizer = QueryLocalizer(reference_sfm, config)
+    localizer = QueryLocalizer(reference_sfm, config, index)
 
-    poses = {}
-    logs = {
-        'features': features,
-        'matches': matches,
-        'retrieval': retrieval,
-        'loc': {},
-    }
-    logger.info('Starting localization...')
-    for qname, qcam in tqdm(queries):
+    tasks = []
+    for idx, (qname, _) in enumerate(queries):
         if qname not in retrieval_dict:
             logger.warning(
                 f'No images retrieved for query image {qname}. Skipping...')
@@ -170,40 +294,66 @@ def main(reference_sfm: Union[Path, pycolmap.Reconstruction],
                 logger.warning(f'Image {n} was retrieved but not in database')
                 continue
             db_ids.append(db_name_to_id[n])
+        tasks.append((idx, db_ids))
+
+    if num_workers > 1 and 'fork' not in mp.get_all_start_methods():
+        logger.warning('Parallel localization requires forking processes, '
+                       'localizing the queries sequentially.')
+        num_workers = 1
+    if num_workers > 1 and not hasattr(pycolmap, 'set_random_seed'):
+        logger.warning('This version of pycolmap cannot be seeded, RANSAC '
+                       'might draw different samples than a serial run.')
 
-        if covisibility_clustering:
-            clusters = do_covisibility_clustering(db_ids, reference_sfm)
-            best_inliers = 0
-            best_cluster = None
-            logs_clusters = []
-            for i, cluster_ids in enumerate(clusters):
-                ret, log = pose_from_cluster(
-                        localizer, qname, qcam, cluster_ids, features, matches)
-                if ret['success'] and ret['num_inliers'] > best_inliers:
-                    best_cluster = i
-                    best_inliers = ret['num_inliers']
-                logs_clusters.append(log)
-            if best_cluster is not None:
-                ret = logs_clusters[best_cluster]['PnP_ret']
-                poses[qname] = (ret['qvec'], ret['tvec'])
-            logs['loc'][qname] = {
-                'db': db_ids,
-                'best_cluster': best_cluster,
-                'log_clusters': logs_clusters,
-                'covisibility_clustering': covisibility_clustering,
-            }
+    poses = {}
+    latencies = []
+    num_clusters = num_skipped = 0
+    logs_path = get_logs_path(results)
+    logger.info('Starting localization...')
+    with contextlib.ExitStack() as stack:
+        # the logs are streamed to disk instead of being kept in memory
+        log_writer = stack.enter_context(LocLogWriter(
+            logs_path, features=features, matches=matches,
+            retrieval=retrieval))
+        if num_workers > 1:
+            _worker_state.update(
+                localizer=localizer, queries=queries, features=features,
+                matches=matches, covisibility_clustering=covisibility_clustering,
+                cluster_ranking=cluster_ranking,
+                stop_num_inliers=stop_num_inliers)
+            stack.callback(_worker_state.clear)
+            pool = stack.enter_context(
+                mp.get_context('fork').Pool(num_workers))
+            # the results are yielded in the order of the tasks
+            outputs = pool.imap(_localize_worker, tasks)
         else:
-            ret, log = pose_from_cluster(
-                    localizer, qname, qcam, db_ids, features, matches)
-            if ret['success']:
-                poses[qname] = (ret['qvec'], ret['tvec'])
-            else:
+            match_reader = stack.enter_context(MatchReader(matches))
+            outputs = (localize_query(
+                localizer, *queries[idx], db_ids, features, match_reader,
+                covisibility_clustering, cluster_ranking, stop_num_inliers)
+                for idx, db_ids in tasks)
+
+        for (idx, db_ids), (pose, log) in zip(
+                tasks, tqdm(outputs, total=len(tasks))):
+            qname = queries[idx][0]
+            if pose is None and not covisibility_clustering:
                 closest = reference_sfm.images[db_ids[0]]
-                poses[qname] = (closest.qvec, closest.tvec)
-            log['covisibility_clustering'] = covisibility_clustering
-            logs['loc'][qname] = log
+                pose = (closest.qvec, closest.tvec)
+            if pose is not None:
+                poses[qname] = pose
+            log_writer.write(qname, log)
+            latencies.append(log['latency'])
+            if covisibility_clustering:
+                num_clusters += len(log['log_clusters'])
+                num_skipped += len(log['skipped_clusters'])
 
     logger.info(f'Localized {len(poses)} / {len(queries)} images.')
+    logger.info(f'Wrote logs to {logs_path}.')
+    if len(latencies) > 0:
+        logger.info('Localization time per query: '
+                    f'{np.mean(latencies)*1e3:.1f} ms on average, '
+                    f'{np.median(latencies)*1e3:.1f} ms median.')
+    if covisibility_clustering:
+        logger.info(f'Skipped {num_skipped} / {num_clusters} clusters.')
     logger.info(f'Writing poses to {results}...')
     with open(results, 'w') as f:
         for q in poses:
@@ -214,11 +364,6 @@ def main(reference_sfm: Union[Path, pycolmap.Reconstruction],
             if prepend_camera_name:
                 name = q.split('/')[-2] + '/' + name
             f.write(f'{name} {qvec} {tvec}\n')
-
-    logs_path = f'{results}_logs.pkl'
-    logger.info(f'Writing logs to {logs_path}...')
-    with open(logs_path, 'wb') as f:
-        pickle.dump(logs, f)
     logger.info('Done!')
 
 
@@ -233,5 +378,11 @@ if __name__ == '__main__':
     parser.add_argument('--ransac_thresh', type=float, default=12.0)
     parser.add_argument('--covisibility_clustering', action='store_true')
     parser.add_argument('--prepend_camera_name', action='store_true')
+    parser.add_argument('--num_workers', type=int, default=1)
+    parser.add_argument('--cluster_ranking', type=str,
+                        choices=['matches', 'retrieval'])
+    parser.add_argument('--stop_num_inliers', type=int,
+                        help='skip the remaining clusters once a pose has '
+                        'this number of inliers')
     args = parser.parse_args()
     main(**args.__dict__)
@@ -1,16 +1,18 @@
 import argparse
-from typing import Union, Optional, Dict, List, Tuple
+from typing import Callable, Union, Optional, Dict, List, Tuple
+from collections import defaultdict
 from pathlib import Path
 import pprint
 import collections.abc as collections
 from tqdm import tqdm
 import h5py
 import torch
+import torch.nn.functional as F
 
 from . import matchers, logger
 from .utils.base_model import dynamic_load
 from .utils.parsers import names_to_pair, names_to_pair_old, parse_retrieval
-from .utils.io import list_h5_names
+from .utils.io import list_h5_names, FeatureCache, H5Writer
 
 
 '''
@@ -18,6 +20,10 @@ A set of standard configurations that can be directly selected from the command
 line using their name. Each is a dictionary with the following entries:
     - output: the name of the match file that will be generated.
     - model: the model configuration, as passed to a feature matcher.
+    - cache_size (optional): number of images whose features are kept in
+      memory while matching (default: 128).
+    - batch_size (optional): number of pairs matched in a single forward
+      pass, only used by matchers that support batching (default: 1).
 '''
 confs = {
     'superglue': {
@@ -96,11 +102,12 @@ def main(conf: Dict,
 
 
 def find_unique_new_pairs(pairs_all: List[Tuple[str]], match_path: Path = None):
-    '''Avoid to recompute duplicates to save time.'''
-    pairs = set()
+    '''Avoid to recompute duplicates to save time.
+       The order of the pairs is preserved to benefit from feature caching.'''
+    pairs = {}
     for i, j in pairs_all:
         if (j, i) not in pairs:
-            pairs.add((i, j))
+            pairs[(i, j)] = None
     pairs = list(pairs)
     if match_path is not None and match_path.exists():
         with h5py.File(str(match_path), 'r') as fd:
@@ -116,6 +123,85 @@ def find_unique_new_pairs(pairs_all: List[Tuple[str]], match_path: Path = None):
     return pairs
 
 
+def group_names(names: List[str], batch_size: int,
+                key: Optional[Callable] = None) -> List[List[str]]:
+    '''Split names into batches, optionally of names with the same key.'''
+    groups = defaultdict(list)
+    for name in names:
+        groups[None if key is None else key(name)].append(name)
+    return [g[i:i+batch_size] for g in groups.values()
+            for i in range(0, len(g), batch_size)]
+
+
+def load_image(cache: FeatureCache, path: Path, name: str,
+               device: str) -> Dict:
+    feats = cache.get(path, name)
+    data = {k: torch.from_numpy(v).float().to(device)
+            for k, v in feats.items()}
+    # some matchers might expect an image but only use its size
+    data['image'] = torch.empty((1,)+tuple(feats['image_size'])[::-1])
+    return data
+
+
+def collate_images(datas: List[Dict], suffix: str) -> Dict:
+    '''Stack the data of several images, padding their keypoints to the
+       largest number in the batch. Valid keypoints are indicated by the
+       mask and keys are suffixed by the index of the image in the pair.'''
+    nums = [len(d['keypoints']) for d in datas]
+    num = max(nums)
+    device = datas[0]['keypoints'].device
+    batch = {'mask'+suffix: torch.stack(
+        [torch.arange(num, device=device) < n for n in nums])}
+    for k in datas[0]:
+        v = [d[k] for d in datas]
+        if k == 'descriptors':
+            v = [F.pad(x, (0, num - x.shape[-1])) for x in v]
+        elif k in ('keypoints', 'scores'):
+            v = [F.pad(x, (0, 0)*(x.dim()-1) + (0, num - len(x)))
+                 for x in v]
+        elif k == 'image':
+            # only the size of the image is used, avoid allocating it
+            size = tuple(max(s) for s in zip(*[x.shape for x in v]))
+            batch[k+suffix] = torch.empty(size)[None].expand(len(v), *size)
+            continue
+        batch[k+suffix] = torch.stack(v)
+    return batch
+
+
+def is_out_of_memory(error: RuntimeError) -> bool:
+    msg = str(error)
+    return 'out of memory' in msg or "can't allocate memory" in msg
+
+
+def unbatch_matches(pred: Dict, size: int) -> List[Dict]:
+    matches = []
+    for b in range(size):
+        m = {'matches0': pred['matches0'][b].cpu().short().numpy()}
+        if 'matching_scores0' in pred:
+            m['matching_scores0'] = \
+                pred['matching_scores0'][b].cpu().half().numpy()
+        matches.append(m)
+    return matches
+
+
+def match_batch(model, data0: Dict, datas1: List[Dict]) -> List[Dict]:
+    '''Match an image to several others in a single forward pass, or to one
+       at a time if the batch does not fit in memory.'''
+    if len(datas1) > 1:
+        try:
+            pred = model({**data0, **collate_images(datas1, '1')})
+            return unbatch_matches(pred, len(datas1))
+        except RuntimeError as error:
+            if not is_out_of_memory(error):
+                raise error
+            logger.warning(f'Out of memory when matching {len(datas1)} pairs, '
+                           'matching them one at a time.')
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+    return [unbatch_matches(model({**data0, **collate_images([d], '1')}), 1)[0]
+            for d in datas1]
+
+
 @torch.no_grad()
 def match_from_paths(conf: Dict,
                      pairs_path: Path,
@@ -147,33 +233,45 @@ def match_from_paths(conf: Dict,
     Model = dynamic_load(matchers, conf['model']['name'])
     model = Model(conf['model']).eval().to(device)
 
-    for (name0, name1) in tqdm(pairs, smoothing=.1):
-        data = {}
-        with h5py.File(str(feature_path_q), 'r') as fd:
-            grp = fd[name0]
-            for k, v in grp.items():
-                data[k+'0'] = torch.from_numpy(v.__array__()).float().to(device)
-            # some matchers might expect an image but only use its size
-            data['image0'] = torch.empty((1,)+tuple(grp['image_size'])[::-1])
-        with h5py.File(str(feature_paths_refs[name2ref[name1]]), 'r') as fd:
-            grp = fd[name1]
-            for k, v in grp.items():
-                data[k+'1'] = torch.from_numpy(v.__array__()).float().to(device)
-            data['image1'] = torch.empty((1,)+tuple(grp['image_size'])[::-1])
-        data = {k: v[None] for k, v in data.items()}
-
-        pred = model(data)
-        pair = names_to_pair(name0, name1)
-        with h5py.File(str(match_path), 'a') as fd:
-            if pair in fd:
-                del fd[pair]
-            grp = fd.create_group(pair)
-            matches = pred['matches0'][0].cpu().short().numpy()
-            grp.create_dataset('matches0', data=matches)
-
-            if 'matching_scores0' in pred:
-                scores = pred['matching_scores0'][0].cpu().half().numpy()
-                grp.create_dataset('matching_scores0', data=scores)
+    # Query-centric schedule: each image is loaded (and encoded) once and
+    # matched to all its retrieved images.
+    pairs_by_query = defaultdict(list)
+    for name0, name1 in pairs:
+        pairs_by_query[name0].append(name1)
+
+    batch_size = conf.get('batch_size', 1)
+    if batch_size > 1 and not Model.supports_batching:
+        logger.warning(f'Matcher {conf["model"]["name"]} does not support '
+                       'batching, matching one pair at a time.')
+        batch_size = 1
+
+    cache = FeatureCache(
+        [feature_path_q] + feature_paths_refs, conf.get('cache_size', 128))
+    key = None
+    if batch_size > 1 and not getattr(Model, 'supports_padding', False):
+        # group the images with identical numbers of keypoints and sizes
+        def key(name):
+            grp = cache.files[str(feature_paths_refs[name2ref[name]])][name]
+            return len(grp['keypoints']), tuple(grp['image_size'][()])
+
+    with cache, H5Writer(match_path) as writer, \
+            tqdm(total=len(pairs), smoothing=.1) as pbar:
+        for name0, names1 in pairs_by_query.items():
+            data0 = collate_images(
+                [load_image(cache, feature_path_q, name0, device)], '0')
+            if hasattr(model, 'encode_keypoints') and \
+                    data0['keypoints0'].shape[1] > 0:
+                data0['encoded0'] = model.encode_keypoints(data0, '0')
+            for batch in group_names(names1, batch_size, key):
+                datas1 = [load_image(
+                    cache, feature_paths_refs[name2ref[n]], n, device)
+                    for n in batch]
+                for name1, matches in zip(
+                        batch, match_batch(model, data0, datas1)):
+                    writer.write(names_to_pair(name0, name1), matches)
+                pbar.update(len(batch))
+    logger.debug(f'Feature cache: {cache.num_hits} hits, '
+                 f'{cache.num_misses} misses.')
 
     logger.info('Finished exporting matches.')
 
@@ -3,12 +3,19 @@ import torch
 from ..utils.base_model import BaseModel
 
 
-def find_nn(sim, ratio_thresh, distance_thresh):
+def find_nn(sim, ratio_thresh, distance_thresh, use_ratio=None):
+    '''use_ratio optionally enables the ratio test per batch item.'''
+    if sim.size(-1) < 2:
+        ratio_thresh = None
     sim_nn, ind_nn = sim.topk(2 if ratio_thresh else 1, dim=-1, largest=True)
     dist_nn = 2 * (1 - sim_nn)
-    mask = torch.ones(ind_nn.shape[:-1], dtype=torch.bool, device=sim.device)
+    # padded entries have an infinite distance
+    mask = torch.isfinite(sim_nn[..., 0])
     if ratio_thresh:
-        mask = mask & (dist_nn[..., 0] <= (ratio_thresh**2)*dist_nn[..., 1])
+        ratio_ok = dist_nn[..., 0] <= (ratio_thresh**2)*dist_nn[..., 1]
+        if use_ratio is not None:
+            ratio_ok = ratio_ok | ~use_ratio[:, None]
+        mask = mask & ratio_ok
     if distance_thresh:
         mask = mask & (dist_nn[..., 0] <= distance_thresh**2)
     matches = torch.where(mask, ind_nn[..., 0], ind_nn.new_tensor(-1))
@@ -31,30 +38,45 @@ class NearestNeighbor(BaseModel):
         'do_mutual_check': True,
     }
     required_inputs = ['descriptors0', 'descriptors1']
+    supports_batching = True
+    # Padded descriptors are ignored using the optional mask0 and mask1.
+    supports_padding = True
 
     def _init(self, conf):
         pass
 
     def _forward(self, data):
-        if data['descriptors0'].size(-1) == 0 or data['descriptors1'].size(-1) == 0:
+        desc0, desc1 = data['descriptors0'], data['descriptors1']
+        b = max(desc0.shape[0], desc1.shape[0])
+        if desc0.size(-1) == 0 or desc1.size(-1) == 0:
             matches0 = torch.full(
-                data['descriptors0'].shape[:2], -1,
-                device=data['descriptors0'].device)
+                (b, desc0.size(-1)), -1, device=desc0.device)
             return {
                 'matches0': matches0,
                 'matching_scores0': torch.zeros_like(matches0)
             }
-        ratio_threshold = self.conf['ratio_threshold']
-        if data['descriptors0'].size(-1) == 1 or data['descriptors1'].size(-1) == 1:
-            ratio_threshold = None
-        sim = torch.einsum(
-            'bdn,bdm->bnm', data['descriptors0'], data['descriptors1'])
+        # as for a single pair, no ratio test if an image has 1 keypoint
+        if 'mask0' in data:
+            num0, num1 = data['mask0'].sum(-1), data['mask1'].sum(-1)
+        else:
+            num0, num1 = desc0.new_tensor([desc0.size(-1)]), \
+                desc1.new_tensor([desc1.size(-1)])
+        use_ratio = ((num0 >= 2) & (num1 >= 2)).expand(b)
+        if desc0.shape[0] == 1 and b > 1:
+            # a single image matched to many: compute all in one product
+            sim = torch.einsum('dn,bdm->bnm', desc0[0], desc1)
+        else:
+            sim = torch.einsum('bdn,bdm->bnm', desc0, desc1)
+        if 'mask0' in data:
+            mask = data['mask0'][:, :, None] & data['mask1'][:, None]
+            sim = sim.masked_fill(~mask, float('-inf'))
         matches0, scores0 = find_nn(
-            sim, ratio_threshold, self.conf['distance_threshold'])
+            sim, self.conf['ratio_threshold'],
+            self.conf['distance_threshold'], use_ratio)
         if self.conf['do_mutual_check']:
             matches1, scores1 = find_nn(
-                sim.transpose(1, 2), ratio_threshold,
-                self.conf['distance_threshold'])
+                sim.transpose(1, 2), self.conf['ratio_threshold'],
+                self.conf['distance_threshold'], use_ratio)
             matches0 = mutual_check(matches0, matches1)
         return {
             'matches0': matches0,
@@ -1,10 +1,12 @@
 import sys
 from pathlib import Path
+import torch
 
 from ..utils.base_model import BaseModel
 
 sys.path.append(str(Path(__file__).parent / '../../third_party'))
-from SuperGluePretrainedNetwork.models.superglue import SuperGlue as SG
+from SuperGluePretrainedNetwork.models.superglue import (  # noqa E402
+    SuperGlue as SG, normalize_keypoints, log_optimal_transport, arange_like)
 
 
 class SuperGlue(BaseModel):
@@ -17,9 +19,64 @@ class SuperGlue(BaseModel):
         'image0', 'keypoints0', 'scores0', 'descriptors0',
         'image1', 'keypoints1', 'scores1', 'descriptors1',
     ]
+    # SuperGlue cannot ignore padded keypoints, so batched pairs must have
+    # the same numbers of keypoints and image sizes.
+    supports_batching = True
 
     def _init(self, conf):
         self.net = SG(conf)
 
+    def encode_keypoints(self, data, i):
+        '''Add the keypoint encoding to the descriptors of image i. This can
+           be computed once for an image that is matched multiple times and
+           passed to the model as encoded0 or encoded1.'''
+        kpts = normalize_keypoints(data['keypoints'+i], data['image'+i].shape)
+        return data['descriptors'+i] + self.net.kenc(kpts, data['scores'+i])
+
     def _forward(self, data):
-        return self.net(data)
+        # Same as SG.forward, but the batch dimension of an image that is
+        # shared by all the pairs of the batch can be 1.
+        kpts0, kpts1 = data['keypoints0'], data['keypoints1']
+        b = max(kpts0.shape[0], kpts1.shape[0])
+        if kpts0.shape[1] == 0 or kpts1.shape[1] == 0:  # no keypoints
+            shape0, shape1 = (b, kpts0.shape[1]), (b, kpts1.shape[1])
+            return {
+                'matches0': kpts0.new_full(shape0, -1, dtype=torch.int),
+                'matches1': kpts1.new_full(shape1, -1, dtype=torch.int),
+                'matching_scores0': kpts0.new_zeros(shape0),
+                'matching_scores1': kpts1.new_zeros(shape1),
+            }
+
+        desc0, desc1 = [
+            data['encoded'+i] if 'encoded'+i in data
+            else self.encode_keypoints(data, i) for i in '01']
+        desc0 = desc0.expand(b, -1, -1).contiguous()
+        desc1 = desc1.expand(b, -1, -1).contiguous()
+
+        desc0, desc1 = self.net.gnn(desc0, desc1)
+        mdesc0, mdesc1 = self.net.final_proj(desc0), self.net.final_proj(desc1)
+
+        scores = torch.einsum('bdn,bdm->bnm', mdesc0, mdesc1)
+        scores = scores / self.net.config['descriptor_dim']**.5
+        scores = log_optimal_transport(
+            scores, self.net.bin_score,
+            iters=self.net.config['sinkhorn_iterations'])
+
+        max0, max1 = scores[:, :-1, :-1].max(2), scores[:, :-1, :-1].max(1)
+        indices0, indices1 = max0.indices, max1.indices
+        mutual0 = arange_like(indices0, 1)[None] == indices1.gather(1, indices0)
+        mutual1 = arange_like(indices1, 1)[None] == indices0.gather(1, indices1)
+        zero = scores.new_tensor(0)
+        mscores0 = torch.where(mutual0, max0.values.exp(), zero)
+        mscores1 = torch.where(mutual1, mscores0.gather(1, indices1), zero)
+        valid0 = mutual0 & (mscores0 > self.net.config['match_threshold'])
+        valid1 = mutual1 & valid0.gather(1, indices1)
+        indices0 = torch.where(valid0, indices0, indices0.new_tensor(-1))
+        indices1 = torch.where(valid1, indices1, indices1.new_tensor(-1))
+
+        return {
+            'matches0': indices0,  # use -1 for invalid match
+            'matches1': indices1,  # use -1 for invalid match
+            'matching_scores0': mscores0,
+            'matching_scores1': mscores1,
+        }
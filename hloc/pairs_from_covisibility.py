@@ -1,53 +1,51 @@
 import argparse
 from pathlib import Path
 import numpy as np
+from scipy.sparse import csr_matrix
 from tqdm import tqdm
-from collections import defaultdict
 
 from . import logger
-from .utils.read_write_model import read_model
-
-
-def main(model, output, num_matched):
+from .utils.columnar_model import (
+    get_covisibility_counts, load_columnar_model)
+
+
+def top_k_per_row(counts: csr_matrix, k: int):
+    '''Columns of the k largest counts of each row, by decreasing count and
+       increasing column for equal counts.'''
+    rows = np.repeat(np.arange(counts.shape[0]), np.diff(counts.indptr))
+    # the columns are sorted within each row, the stable sort keeps them so
+    max_count = counts.data.max(initial=0)
+    order = np.argsort(rows * (max_count + 1) + max_count - counts.data,
+                       kind='stable')
+    rank = np.arange(len(order)) - counts.indptr[rows[order]]
+    keep = order[rank < k]
+    return rows[keep], counts.indices[keep]
+
+
+def main(model, output, num_matched, chunk_size=128):
+    '''The first call writes a memory-mapped copy of the model to
+       model/hloc_columns.bin, which the next calls load instead of parsing
+       the model, until the model files change.'''
     logger.info('Reading the COLMAP model...')
-    cameras, images, points3D = read_model(model)
+    model = load_columnar_model(model, cache=True)
+    names = model.images['names']
 
     logger.info('Extracting image pairs from covisibility info...')
-    pairs = []
-    for image_id, image in tqdm(images.items()):
-        matched = image.point3D_ids != -1
-        points3D_covis = image.point3D_ids[matched]
-
-        covis = defaultdict(int)
-        for point_id in points3D_covis:
-            for image_covis_id in points3D[point_id].image_ids:
-                if image_covis_id != image_id:
-                    covis[image_covis_id] += 1
-
-        if len(covis) == 0:
-            logger.info(f'Image {image_id} does not have any covisibility.')
-            continue
-
-        covis_ids = np.array(list(covis.keys()))
-        covis_num = np.array([covis[i] for i in covis_ids])
-
-        if len(covis_ids) <= num_matched:
-            top_covis_ids = covis_ids[np.argsort(-covis_num)]
-        else:
-            # get covisible image ids with top k number of common matches
-            ind_top = np.argpartition(covis_num, -num_matched)
-            ind_top = ind_top[-num_matched:]  # unsorted top k
-            ind_top = ind_top[np.argsort(-covis_num[ind_top])]
-            top_covis_ids = [covis_ids[i] for i in ind_top]
-            assert covis_num[ind_top[0]] == np.max(covis_num)
-
-        for i in top_covis_ids:
-            pair = (image.name, images[i].name)
-            pairs.append(pair)
-
-    logger.info(f'Found {len(pairs)} pairs.')
+    num_pairs = 0
     with open(output, 'w') as f:
-        f.write('\n'.join(' '.join([i, j]) for i, j in pairs))
+        for start in tqdm(range(0, model.num_images, chunk_size)):
+            end = min(start + chunk_size, model.num_images)
+            counts = get_covisibility_counts(model, start, end)
+            for i in np.flatnonzero(np.diff(counts.indptr) == 0):
+                logger.info(f'Image {model.images["ids"][start + i]} '
+                            'does not have any covisibility.')
+            rows, covis_rows = top_k_per_row(counts, num_matched)
+            lines = [f'{names[start + i]} {names[j]}'
+                     for i, j in zip(rows.tolist(), covis_rows.tolist())]
+            if len(lines) > 0:
+                f.write(('\n' if num_pairs > 0 else '') + '\n'.join(lines))
+            num_pairs += len(lines)
+    logger.info(f'Found {num_pairs} pairs.')
 
 
 if __name__ == "__main__":
@@ -55,5 +53,6 @@ if __name__ == "__main__":
     parser.add_argument('--model', required=True, type=Path)
     parser.add_argument('--output', required=True, type=Path)
     parser.add_argument('--num_matched', required=True, type=int)
+    parser.add_argument('--chunk_size', type=int, default=128)
     args = parser.parse_args()
     main(**args.__dict__)
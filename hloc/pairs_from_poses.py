@@ -1,51 +1,125 @@
 import argparse
+from typing import Optional
 from pathlib import Path
 import numpy as np
 import scipy.spatial
 
 from . import logger
-from .utils.read_write_model import read_images_binary
+from .utils.read_write_model import (
+    read_images_binary, images_from_columns, qvec2rotmat)
 from .pairs_from_retrieval import pairs_from_score_matrix
 
 DEFAULT_ROT_THRESH = 30  # in degrees
+MAX_DENSE_IMAGES = 4096  # the dense matrices take 16 bytes per pair
+
+
+def get_camera_poses(qvecs, tvecs):
+    '''Camera-to-world rotations and camera centers of stacked poses.'''
+    Rs = qvec2rotmat(np.asarray(qvecs).T).transpose(2, 1, 0)
+    ts = -(Rs @ np.asarray(tvecs)[:, :, None])[:, :, 0]
+    return Rs, ts
+
+
+def trace_to_angle(trace):
+    '''Rotation angles in degrees from the traces of R0^T.R1.'''
+    dR = np.clip((trace - 1) / 2, -1., 1.)
+    return np.rad2deg(np.abs(np.arccos(dR)))
 
 
 def get_pairwise_distances(images):
     ids = np.array(list(images.keys()))
-    Rs = []
-    ts = []
-    for id_ in ids:
-        image = images[id_]
-        R = image.qvec2rotmat()
-        t = image.tvec
-        Rs.append(R)
-        ts.append(t)
-    Rs = np.stack(Rs, 0)
-    ts = np.stack(ts, 0)
-
-    Rs = Rs.transpose(0, 2, 1)
-    ts = -(Rs @ ts[:, :, None])[:, :, 0]
+    Rs, ts = get_camera_poses([images[i].qvec for i in ids],
+                              [images[i].tvec for i in ids])
 
     dist = scipy.spatial.distance.squareform(scipy.spatial.distance.pdist(ts))
-    trace = np.einsum('nji,mji->mn', Rs, Rs, optimize=True)
-    dR = np.clip((trace - 1) / 2, -1., 1.)
-    dR = np.rad2deg(np.abs(np.arccos(dR)))
+    dR = trace_to_angle(np.einsum('nji,mji->mn', Rs, Rs, optimize=True))
     return ids, dist, dR
 
 
-def main(model, output, num_matched, rotation_threshold=DEFAULT_ROT_THRESH):
+def select_exhaustive(Rs, ts, rows, num_matched, rotation_threshold,
+                      max_distance):
+    '''Select the pairs of some rows by evaluating all the images.'''
+    dist = scipy.spatial.distance.cdist(ts[rows], ts)
+    dist[trace_to_angle(np.einsum('mji,nji->mn', Rs[rows], Rs))
+         >= rotation_threshold] = np.inf
+    dist[dist >= max_distance] = np.inf
+    dist[np.arange(len(rows)), rows] = np.inf
+    idxs = np.argsort(dist, axis=1, kind='stable')[:, :num_matched]
+    valid = np.isfinite(np.take_along_axis(dist, idxs, axis=1))
+    return [idxs[i][valid[i]] for i in range(len(rows))]
+
+
+def pairs_from_kdtree(Rs, ts, num_matched, rotation_threshold,
+                      max_distance=None, chunk_size=1 << 20):
+    '''Select the num_matched closest cameras of each camera that are
+       rotated by less than rotation_threshold, as the dense selection. The
+       candidates are the nearest camera centers in a KD-tree, the number of
+       queried neighbors is doubled for the cameras that do not have enough
+       valid candidates, so the memory grows as O(N.k). At most chunk_size
+       candidates are evaluated at once.'''
+    num_images = len(ts)
+    tree = scipy.spatial.cKDTree(ts)
+    bound = np.inf if max_distance is None else max_distance
+    selected = [None] * num_images
+    todo = np.arange(num_images)
+    k = 2 * (num_matched + 1)
+    # querying a large part of the tree is slower than evaluating all images
+    while len(todo) > 0 and 8 * k < num_images:
+        retry = []
+        step = max(chunk_size // k, 1)
+        for start in range(0, len(todo), step):
+            rows = todo[start:start+step]
+            _, idxs = tree.query(ts[rows], k=k, distance_upper_bound=bound,
+                                 workers=-1)
+            found = idxs < num_images  # missing neighbors have index N
+            idxs = np.where(found, idxs, 0)
+            valid = found & (idxs != rows[:, None])
+            valid &= trace_to_angle(np.einsum(
+                'mji,mkji->mk', Rs[rows], Rs[idxs])) < rotation_threshold
+            # all the candidates were queried if the last one is missing
+            complete = (valid.sum(1) >= num_matched) | ~found[:, -1]
+            for i in np.flatnonzero(complete):
+                selected[rows[i]] = idxs[i][valid[i]][:num_matched]
+            retry.append(rows[~complete])
+        todo = np.concatenate(retry)
+        k *= 2
+
+    step = max(chunk_size // max(num_images, 1), 1)
+    for start in range(0, len(todo), step):
+        rows = todo[start:start+step]
+        for i, idxs in zip(rows, select_exhaustive(
+                Rs, ts, rows, num_matched, rotation_threshold, bound)):
+            selected[i] = idxs
+    return [(i, j) for i in range(num_images) for j in selected[i]]
+
+
+def main(model, output, num_matched, rotation_threshold=DEFAULT_ROT_THRESH,
+         max_distance: Optional[float] = None,
+         use_kdtree: Optional[bool] = None):
     logger.info('Reading the COLMAP model...')
-    images = read_images_binary(model / 'images.bin')
+    images = read_images_binary(model / 'images.bin', columnar=True)
+    names = images['names']
+    if use_kdtree is None:
+        use_kdtree = len(names) > MAX_DENSE_IMAGES
 
-    logger.info(
-        f'Obtaining pairwise distances between {len(images)} images...')
-    ids, dist, dR = get_pairwise_distances(images)
-    scores = -dist
+    if use_kdtree:
+        logger.info(
+            f'Obtaining the nearest neighbors of {len(names)} images...')
+        Rs, ts = get_camera_poses(images['qvecs'], images['tvecs'])
+        pairs = pairs_from_kdtree(
+            Rs, ts, num_matched, rotation_threshold, max_distance)
+    else:
+        logger.info(
+            f'Obtaining pairwise distances between {len(names)} images...')
+        _, dist, dR = get_pairwise_distances(images_from_columns(images))
+        scores = -dist
 
-    invalid = (dR >= rotation_threshold)
-    np.fill_diagonal(invalid, True)
-    pairs = pairs_from_score_matrix(scores, invalid, num_matched)
-    pairs = [(images[ids[i]].name, images[ids[j]].name) for i, j in pairs]
+        invalid = (dR >= rotation_threshold)
+        if max_distance is not None:
+            invalid |= dist >= max_distance
+        np.fill_diagonal(invalid, True)
+        pairs = pairs_from_score_matrix(scores, invalid, num_matched)
+    pairs = [(names[i], names[j]) for i, j in pairs]
 
     logger.info(f'Found {len(pairs)} pairs.')
     with open(output, 'w') as f:
@@ -59,5 +133,9 @@ if __name__ == "__main__":
     parser.add_argument('--num_matched', required=True, type=int)
     parser.add_argument('--rotation_threshold',
                         default=DEFAULT_ROT_THRESH, type=float)
+    parser.add_argument('--max_distance', type=float)
+    parser.add_argument('--use_kdtree', action='store_true', default=None,
+                        help='by default, only for more than '
+                        f'{MAX_DENSE_IMAGES} images')
     args = parser.parse_args()
     main(**args.__dict__)
@@ -1,6 +1,10 @@
 import argparse
+import json
+import re
 from pathlib import Path
-from typing import Optional
+from typing import Callable, List, Optional
+from itertools import chain
+from collections import defaultdict
 import h5py
 import numpy as np
 import torch
@@ -10,7 +14,8 @@ import torch.nn.functional as F
 from . import logger
 from .utils.parsers import parse_image_lists
 from .utils.read_write_model import read_images_binary
-from .utils.io import list_h5_names
+from .utils.io import list_h5_names, NamesIndex, read_names_index
+from .utils.descriptor_store import load_descriptor_store, get_source_stat
 
 
 def parse_names(prefix, names, names_all):
@@ -33,13 +38,24 @@ def parse_names(prefix, names, names_all):
 
 def get_descriptors(names, path, name2idx=None, key='global_descriptor'):
     if name2idx is None:
-        with h5py.File(str(path), 'r') as fd:
-            desc = [fd[n][key].__array__() for n in names]
-    else:
-        desc = []
-        for n in names:
-            with h5py.File(str(path[name2idx[n]]), 'r') as fd:
-                desc.append(fd[n][key].__array__())
+        path, name2idx = [path], {n: 0 for n in names}
+    idxs_by_path = defaultdict(list)
+    for i, n in enumerate(names):
+        idxs_by_path[name2idx[n]].append(i)
+
+    desc = [None] * len(names)
+    for p, idxs in idxs_by_path.items():
+        store = load_descriptor_store(path[p], key)
+        if store is not None:
+            # memory-mapped, not copied if all names are read in order
+            d = store.get([names[i] for i in idxs])
+            if len(idxs_by_path) == 1:
+                return torch.from_numpy(d).float()
+        else:
+            with h5py.File(str(path[p]), 'r') as fd:
+                d = [fd[names[i]][key].__array__() for i in idxs]
+        for i, x in zip(idxs, d):
+            desc[i] = x
     return torch.from_numpy(np.stack(desc, 0)).float()
 
 
@@ -65,19 +81,196 @@ def pairs_from_score_matrix(scores: torch.Tensor,
     return pairs
 
 
+def find_topk(query_desc, db_desc, k, self_idxs=None, min_score=None,
+              db_block_size=65536):
+    '''Find the k most similar database descriptors of each query with a
+       running top-k over shards of the database. Invalid entries have
+       -inf scores, e.g. self matches (given by the database index of each
+       query or -1) and scores below min_score.'''
+    scores = query_desc.new_full((len(query_desc), 0), float('-inf'))
+    indices = torch.zeros((len(query_desc), 0), dtype=torch.long,
+                          device=query_desc.device)
+    for start in range(0, len(db_desc), db_block_size):
+        db_block = db_desc[start:start+db_block_size]
+        sim = torch.einsum('id,jd->ij', query_desc, db_block)
+        if self_idxs is not None:
+            rows = torch.where(
+                (self_idxs >= start) & (self_idxs < start+len(db_block)))[0]
+            sim[rows, self_idxs[rows]-start] = float('-inf')
+        if min_score is not None:
+            sim.masked_fill_(sim < min_score, float('-inf'))
+        idxs = torch.arange(start, start+len(db_block), device=sim.device)
+        scores = torch.cat([scores, sim], 1)
+        indices = torch.cat([indices, idxs[None].expand(len(sim), -1)], 1)
+        scores, topk = torch.topk(scores, min(k, scores.shape[1]), dim=1)
+        indices = torch.gather(indices, 1, topk)
+    return scores, indices
+
+
+def expand_descriptors(desc, db_desc, scores, indices, alpha=None):
+    '''Add to each descriptor a combination of its retrieved neighbors,
+       given by their scores and database indices (-inf scores are ignored).
+       Neighbors are averaged, or weighted by their similarity to the power
+       alpha (alpha-QE and alpha-DBA).'''
+    valid = scores.isfinite()
+    neighbors = db_desc[torch.where(valid, indices, indices.new_tensor(0))]
+    if alpha is None:
+        weights = valid.float() / valid.sum(1, keepdim=True).clamp(min=1)
+    else:
+        weights = torch.where(
+            valid, scores.clamp(min=0)**alpha, scores.new_tensor(0))
+    desc = desc + torch.einsum('in,ind->id', weights, neighbors)
+    return F.normalize(desc, p=2, dim=-1)
+
+
 def average_query_expansion(query_desc, db_desc, similarities, N=5):
-    new_query_desc = []
-    for q, s in zip(query_desc, similarities):
-        query_exp = db_desc[torch.topk(s, N).indices]
-        q = q.unsqueeze(0) + query_exp.mean(dim=0, keepdims=True)
-        q = F.normalize(q, p=2, dim=-1)
-        new_query_desc.append(q)
-    return torch.cat(new_query_desc, 0)
+    scores, indices = torch.topk(similarities, N, dim=1)
+    return expand_descriptors(query_desc, db_desc, scores, indices)
+
+
+def get_dba_path(descriptors: Path, N: int, alpha=None) -> Path:
+    ext = f'_dba{N}' + (f'_alpha{alpha}' if alpha is not None else '')
+    return Path(str(descriptors).replace('.h5', ext + '.h5'))
+
+
+def get_dba_sources(sources: List[Path]) -> str:
+    return json.dumps([get_source_stat(p) for p in sources])
+
+
+def is_dba_fresh(path: Path, db_names: List[str],
+                 sources: List[Path]) -> bool:
+    '''Check that augmented descriptors were computed against exactly the
+       same database images and descriptor files.'''
+    if not path.exists():
+        return False
+    with h5py.File(str(path), 'r') as fd:
+        return fd.attrs.get('sources') == get_dba_sources(sources) and \
+            read_names_index(fd) == list(db_names)
+
+
+def database_side_augmentation(db_desc, db_names, N, output, alpha=None,
+                               device='cpu', block_size=1024,
+                               db_block_size=65536,
+                               key='global_descriptor', sources=()):
+    '''Augment each database descriptor with its N nearest database
+       neighbors and store the results to output, such that they are only
+       computed once per map. The augmented descriptors depend on the whole
+       database, so the stats of the source files are stored with them.'''
+    logger.info(f'Augmenting {len(db_names)} database descriptors...')
+    db_desc = db_desc.to(device)
+    with h5py.File(str(output), 'w') as fd:
+        index = NamesIndex(fd)
+        for start in range(0, len(db_desc), block_size):
+            block = db_desc[start:start+block_size]
+            self_idxs = torch.arange(start, start+len(block), device=device)
+            scores, indices = find_topk(
+                block, db_desc, N, self_idxs, db_block_size=db_block_size)
+            block = expand_descriptors(
+                block, db_desc, scores, indices, alpha).cpu().numpy()
+            names = db_names[start:start+len(block)]
+            for name, desc in zip(names, block):
+                fd.create_group(name).create_dataset(key, data=desc)
+            index.add(names)
+        # written last, such that an interrupted run is not reused
+        fd.attrs['sources'] = get_dba_sources(sources)
+    return output
+
+
+def pairs_from_descriptors(query_desc, db_desc, query_names, db_names,
+                           num_select, query_expansion=None, alpha=None,
+                           device='cpu', block_size=1024, db_block_size=65536):
+    '''Exhaustive search of the most similar database images. The queries are
+       processed in blocks and the pairs of each block are yielded as soon
+       as it is done, such that the memory does not grow with the number of
+       queries times the number of database images.'''
+    name2db = {n: i for i, n in enumerate(db_names)}
+    # Avoid self-matching
+    self_idxs = torch.tensor([name2db.get(n, -1) for n in query_names],
+                             device=device)
+    db_desc = db_desc.to(device)
+    for start in range(0, len(query_desc), block_size):
+        query_block = query_desc[start:start+block_size].to(device)
+        if query_expansion is not None:
+            scores, indices = find_topk(
+                query_block, db_desc, query_expansion,
+                db_block_size=db_block_size)
+            query_block = expand_descriptors(
+                query_block, db_desc, scores, indices, alpha)
+        scores, indices = find_topk(
+            query_block, db_desc, num_select,
+            self_idxs[start:start+block_size], min_score=0,
+            db_block_size=db_block_size)
+        valid = scores.isfinite().cpu().numpy()
+        indices = indices.cpu().numpy()
+        yield [(start+i, indices[i, j]) for i, j in zip(*np.where(valid))]
+
+
+def get_index_path(descriptors: Path, index: str) -> Path:
+    name = re.sub('[^0-9a-zA-Z]+', '-', index)
+    return Path(descriptors).with_suffix(f'.index-{name}.faiss')
+
+
+def load_or_build_index(index: str, path: Path, db_names: List[str],
+                        get_db_desc: Callable, sources: List[Path]):
+    '''Load an approximate search index built with the faiss factory string
+       `index` (e.g. IVF1024,Flat or HNSW32) or build it if it does not exist
+       or was built for different database images or descriptor files. Also
+       return the names of the indexed images, in the order of the index.'''
+    try:
+        import faiss
+    except ImportError:
+        raise ImportError('Approximate search requires faiss, install it '
+                          'with `pip install faiss-cpu`.')
+
+    # the indexed names and the size and modification time of the sources
+    header_path = path.with_suffix('.json')
+    header = {'index': index,
+              'sources': [get_source_stat(p) for p in sources]}
+    if path.exists() and header_path.exists():
+        cached = json.loads(header_path.read_text())
+        index_names = cached.pop('names', [])
+        if cached == header and set(index_names) == set(db_names):
+            logger.info(f'Loading the retrieval index {path.name}.')
+            return faiss.read_index(str(path)), index_names
+        logger.info('The retrieval index was built for different database '
+                    'images or descriptors, rebuilding it.')
+
+    logger.info(f'Building the retrieval index {index}...')
+    db_desc = get_db_desc().numpy()
+    db_index = faiss.index_factory(
+        db_desc.shape[1], index, faiss.METRIC_INNER_PRODUCT)
+    if not db_index.is_trained:
+        db_index.train(db_desc)
+    db_index.add(db_desc)
+    faiss.write_index(db_index, str(path))
+    header_path.write_text(json.dumps({**header, 'names': db_names}))
+    return db_index, db_names
+
+
+def pairs_from_index(db_index, query_desc, query_names, db_names,
+                     num_select, min_score=None):
+    '''Approximate search of the most similar database images.'''
+    name2db = {n: i for i, n in enumerate(db_names)}
+    self_idxs = [name2db.get(n, -1) for n in query_names]
+    # retrieve one more image to account for self-matching
+    k = min(num_select + 1, len(db_names))
+    scores, indices = db_index.search(query_desc.numpy(), k)
+
+    pairs = []
+    for i, self_idx in enumerate(self_idxs):
+        valid = (indices[i] != -1) & (indices[i] != self_idx)
+        if min_score is not None:
+            valid &= scores[i] >= min_score
+        pairs.extend((i, j) for j in indices[i][valid][:num_select])
+    return pairs
 
 
 def main(descriptors, output, num_matched,
          query_prefix=None, query_list=None,
-         db_prefix=None, db_list=None, db_model=None, db_descriptors=None, query_expansion=None):
+         db_prefix=None, db_list=None, db_model=None, db_descriptors=None,
+         query_expansion=None, alpha=None, dba=None,
+         index=None, index_params=None, compare_exact=False,
+         block_size=1024, db_block_size=65536):
     logger.info('Extracting image pairs from a retrieval database.')
 
     # We handle multiple reference feature files.
@@ -99,24 +292,75 @@ def main(descriptors, output, num_matched,
     if len(db_names) == 0:
         raise ValueError('Could not find any database image.')
     query_names = parse_names(query_prefix, query_list, query_names_h5)
+    if len(db_descriptors) == 1:
+        # follow the order of the descriptor store, if any, such that the
+        # database descriptors are memory-mapped without copy
+        store = load_descriptor_store(db_descriptors[0])
+        if store is not None and all(n in store.name2idx for n in db_names):
+            db_names = sorted(db_names, key=store.name2idx.get)
 
     device = 'cuda' if torch.cuda.is_available() else 'cpu'
-    db_desc = get_descriptors(db_names, db_descriptors, name2db)
+    db_desc = None
+
+    def get_db_desc():
+        nonlocal db_desc
+        if db_desc is None:
+            db_desc = get_descriptors(db_names, db_descriptors, name2db)
+        return db_desc
+
     query_desc = get_descriptors(query_names, descriptors)
-    sim = torch.einsum('id,jd->ij', query_desc.to(device), db_desc.to(device))
 
-    if query_expansion is not None:
-        query_desc = average_query_expansion(query_desc, db_desc, sim, N=query_expansion)
-        sim = torch.einsum('id,jd->ij', query_desc.to(device), db_desc.to(device))
+    if dba is not None:
+        dba_path = get_dba_path(db_descriptors[0], dba, alpha)
+        if not is_dba_fresh(dba_path, db_names, db_descriptors):
+            database_side_augmentation(
+                get_db_desc(), db_names, dba, dba_path, alpha, device,
+                block_size, db_block_size, sources=db_descriptors)
+        db_descriptors = [dba_path]
+        name2db = {n: 0 for n in db_names}
+        db_desc = None
 
-    # Avoid self-matching
-    self = np.array(query_names)[:, None] == np.array(db_names)[None]
-    pairs = pairs_from_score_matrix(sim, self, num_matched, min_score=0)
-    pairs = [(query_names[i], db_names[j]) for i, j in pairs]
+    if index is None:
+        blocks = pairs_from_descriptors(
+            query_desc, get_db_desc(), query_names, db_names, num_matched,
+            query_expansion, alpha, device, block_size, db_block_size)
+    else:
+        db_index, db_names = load_or_build_index(
+            index, get_index_path(db_descriptors[0], index), db_names,
+            get_db_desc, db_descriptors)
+        if index_params is not None:
+            import faiss
+            faiss.ParameterSpace().set_index_parameters(
+                db_index, index_params)
+        if query_expansion is not None:
+            scores, indices = db_index.search(
+                query_desc.numpy(), query_expansion)
+            scores, indices = map(torch.from_numpy, (scores, indices))
+            scores[indices == -1] = float('-inf')
+            query_desc = expand_descriptors(
+                query_desc, get_db_desc(), scores, indices, alpha)
+        pairs = pairs_from_index(
+            db_index, query_desc, query_names, db_names, num_matched,
+            min_score=0)
+        if compare_exact:
+            pairs_exact = list(chain.from_iterable(pairs_from_descriptors(
+                query_desc, get_db_desc(), query_names, db_names,
+                num_matched, device=device, block_size=block_size,
+                db_block_size=db_block_size)))
+            recall = len(set(pairs) & set(pairs_exact)) / len(pairs_exact)
+            logger.info(f'Recall of the approximate search: {recall:.4f}.')
+        blocks = [pairs]
 
-    logger.info(f'Found {len(pairs)} pairs.')
+    num_pairs = 0
     with open(output, 'w') as f:
-        f.write('\n'.join(' '.join([i, j]) for i, j in pairs))
+        for pairs in blocks:
+            if len(pairs) == 0:
+                continue
+            f.write('\n' if num_pairs > 0 else '')
+            f.write('\n'.join(
+                ' '.join([query_names[i], db_names[j]]) for i, j in pairs))
+            num_pairs += len(pairs)
+    logger.info(f'Found {num_pairs} pairs.')
 
 
 if __name__ == "__main__":
@@ -130,5 +374,19 @@ if __name__ == "__main__":
     parser.add_argument('--db_list', type=Path)
     parser.add_argument('--db_model', type=Path)
     parser.add_argument('--db_descriptors', type=Path)
+    parser.add_argument('--query_expansion', type=int)
+    parser.add_argument('--alpha', type=float,
+                        help='weight neighbors by their similarity to the '
+                        'power alpha in query expansion and DBA')
+    parser.add_argument('--dba', type=int,
+                        help='number of neighbors used for database-side '
+                        'augmentation')
+    parser.add_argument('--index', type=str,
+                        help='faiss index factory string, e.g. IVF1024,Flat')
+    parser.add_argument('--index_params', type=str,
+                        help='faiss search parameters, e.g. nprobe=16')
+    parser.add_argument('--compare_exact', action='store_true')
+    parser.add_argument('--block_size', type=int, default=1024)
+    parser.add_argument('--db_block_size', type=int, default=65536)
     args = parser.parse_args()
     main(**args.__dict__)
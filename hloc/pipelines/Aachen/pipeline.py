@@ -6,6 +6,7 @@ import argparse
 from ... import extract_features, match_features, whitening
 from ... import pairs_from_covisibility, pairs_from_retrieval
 from ... import colmap_from_nvm, triangulation, localize_sfm
+from ...utils import descriptor_store
 
 
 parser = argparse.ArgumentParser()
@@ -30,6 +31,12 @@ parser.add_argument('--multiscale', type=str, default='[1]',
                     " examples: '[1]' | '[1, 1/2**(1/2), 1/2]' | '[1, 2**(1/2), 1/2**(1/2)]' (default: '[1]')")
 parser.add_argument('--query_expansion', type=int, default=None,
                     help='Number of target images used for query expansion, default: %(default)s')
+parser.add_argument('--alpha', type=float, default=None,
+                    help='Power of the similarity weights of alpha-QE and '
+                    'alpha-DBA, default: %(default)s')
+parser.add_argument('--dba', type=int, default=None,
+                    help='Number of neighbors used for database-side '
+                    'augmentation, default: %(default)s')
 parser.add_argument('--whitening', action='store_true',
                     help='Flag indicator for feature whitening')
 parser.add_argument('--use_todaygan', action='store_true',
@@ -51,6 +58,8 @@ reference_sfm = outputs / 'sfm_superpoint+superglue'  # the SfM model we will bu
 sfm_pairs = outputs / f'pairs-db-covis{args.num_covis}.txt'  # top-k most covisible in SIFT model
 
 ext += f'_qe{args.query_expansion}' if args.query_expansion is not None else ''
+ext += f'_dba{args.dba}' if args.dba is not None else ''
+ext += f'_alpha{args.alpha}' if args.alpha is not None else ''
 loc_pairs = outputs / f'pairs-query-{args.retrieval}{args.num_loc}{ext}.txt'
 results = outputs / f'Aachen_hloc_superpoint+{args.matching}_{args.retrieval}{args.num_loc}{ext}.txt'
 
@@ -89,11 +98,14 @@ if args.im_size is not None and 'resize_min' in retrieval_conf['preprocessing']:
     retrieval_conf['preprocessing']['resize_min'] = args.im_size
     retrieval_conf['output'] += f'_{args.im_size}'
 global_descriptors = extract_features.main(retrieval_conf, images, outputs, use_todaygan=args.use_todaygan)
+descriptor_store.main(global_descriptors)
 if args.whitening:
     global_descriptors = whitening.main(global_descriptors)
+    descriptor_store.main(global_descriptors)
 pairs_from_retrieval.main(
     global_descriptors, loc_pairs, args.num_loc,
-    query_prefix='query', db_model=reference_sfm, query_expansion=args.query_expansion)
+    query_prefix='query', db_model=reference_sfm, query_expansion=args.query_expansion,
+    alpha=args.alpha, dba=args.dba)
 loc_matches = match_features.main(
     matcher_conf, loc_pairs, feature_conf['output'], outputs)
 
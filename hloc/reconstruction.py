@@ -78,7 +78,8 @@ def run_reconstruction(sfm_dir, database_path, image_dir, verbose=False):
 def main(sfm_dir, image_dir, pairs, features, matches,
          camera_mode=pycolmap.CameraMode.AUTO, verbose=False,
          skip_geometric_verification=False, min_match_score=None,
-         image_list: Optional[List[str]] = None):
+         image_list: Optional[List[str]] = None, chunk_size=1024,
+         num_workers=0):
 
     assert features.exists(), features
     assert pairs.exists(), pairs
@@ -92,7 +93,8 @@ def main(sfm_dir, image_dir, pairs, features, matches,
     image_ids = get_image_ids(database)
     import_features(image_ids, database, features)
     import_matches(image_ids, database, pairs, matches,
-                   min_match_score, skip_geometric_verification)
+                   min_match_score, skip_geometric_verification,
+                   chunk_size, num_workers)
     if not skip_geometric_verification:
         geometric_verification(database, pairs, verbose)
     reconstruction = run_reconstruction(sfm_dir, database, image_dir, verbose)
@@ -115,6 +117,10 @@ if __name__ == '__main__':
                         choices=list(pycolmap.CameraMode.__members__.keys()))
     parser.add_argument('--skip_geometric_verification', action='store_true')
     parser.add_argument('--min_match_score', type=float)
+    parser.add_argument('--chunk_size', type=int, default=1024,
+                        help='number of pairs imported at once')
+    parser.add_argument('--num_workers', type=int, default=0,
+                        help='number of threads reading the matches')
     parser.add_argument('--verbose', action='store_true')
     args = parser.parse_args()
 
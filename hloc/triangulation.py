@@ -1,14 +1,20 @@
 import argparse
+import collections
+from concurrent.futures import ThreadPoolExecutor
 import contextlib
 import io
 import sys
+import threading
 from pathlib import Path
 from tqdm import tqdm
+import numpy as np
+import h5py
 import pycolmap
 
 from . import logger
-from .utils.database import COLMAPDatabase
-from .utils.io import get_keypoints, get_matches
+from .utils.database import COLMAPDatabase, image_ids_to_pair_ids
+from .utils.io import MatchReader
+from .utils.parsers import parse_pairs
 
 
 class OutputCapture:
@@ -52,41 +58,95 @@ def create_db_from_model(reconstruction, database_path):
 def import_features(image_ids, database_path, features_path):
     logger.info('Importing features into the database...')
     db = COLMAPDatabase.connect(database_path)
-
-    for image_name, image_id in tqdm(image_ids.items()):
-        keypoints = get_keypoints(features_path, image_name)
-        keypoints += 0.5  # COLMAP origin
-        db.add_keypoints(image_id, keypoints)
-
-    db.commit()
-    db.close()
+    db.enable_bulk_import()
+
+    def read_keypoints(fd):
+        for image_name, image_id in tqdm(image_ids.items()):
+            keypoints = fd[image_name]['keypoints'].__array__()
+            keypoints += 0.5  # COLMAP origin
+            yield image_id, keypoints
+
+    try:
+        # the keypoints are streamed from the open file into one transaction
+        with h5py.File(str(features_path), 'r') as fd:
+            db.add_keypoints_many(read_keypoints(fd))
+    finally:
+        db.disable_bulk_import()
+        db.close()
+
+
+def read_matches_chunks(matches_path, chunks, num_workers=0):
+    '''Read the matches of chunks of pairs and yield them in the order of the
+       chunks. With num_workers > 0, they are read by worker threads, each
+       with its own handle on the file. h5py serializes all its calls, so
+       this only overlaps the reads with the work of the consumer.'''
+    if num_workers == 0:
+        with MatchReader(matches_path) as reader:
+            for chunk in chunks:
+                yield reader.get_many(chunk)
+        return
+
+    local = threading.local()
+    readers = []
+
+    def read_chunk(chunk):
+        if not hasattr(local, 'reader'):
+            local.reader = MatchReader(matches_path)
+            readers.append(local.reader)
+        return local.reader.get_many(chunk)
+
+    try:
+        with ThreadPoolExecutor(num_workers) as executor:
+            # only a few chunks are read ahead of the consumer
+            futures = collections.deque()
+            for chunk in chunks:
+                futures.append(executor.submit(read_chunk, chunk))
+                if len(futures) > 2 * num_workers:
+                    yield futures.popleft().result()
+            while futures:
+                yield futures.popleft().result()
+    finally:
+        for reader in readers:
+            reader.close()
 
 
 def import_matches(image_ids, database_path, pairs_path, matches_path,
-                   min_match_score=None, skip_geometric_verification=False):
+                   min_match_score=None, skip_geometric_verification=False,
+                   chunk_size=1024, num_workers=0):
     logger.info('Importing matches into the database...')
 
-    with open(str(pairs_path), 'r') as f:
-        pairs = [p.split() for p in f.readlines()]
+    pairs = parse_pairs(pairs_path)
+    ids = np.array([(image_ids[name0], image_ids[name1])
+                    for name0, name1 in pairs], np.int64).reshape(-1, 2)
+    # pairs in both directions have the same id, keep their first occurrence
+    pair_ids = image_ids_to_pair_ids(ids[:, 0], ids[:, 1])
+    _, first = np.unique(pair_ids, return_index=True)
+    keep = np.sort(first)
+    pairs_unique = [pairs[i] for i in keep]
+    ids = ids[keep]
 
     db = COLMAPDatabase.connect(database_path)
-
-    matched = set()
-    for name0, name1 in tqdm(pairs):
-        id0, id1 = image_ids[name0], image_ids[name1]
-        if len({(id0, id1), (id1, id0)} & matched) > 0:
-            continue
-        matches, scores = get_matches(matches_path, name0, name1)
-        if min_match_score:
-            matches = matches[scores > min_match_score]
-        db.add_matches(id0, id1, matches)
-        matched |= {(id0, id1), (id1, id0)}
-
-        if skip_geometric_verification:
-            db.add_two_view_geometry(id0, id1, matches)
-
-    db.commit()
-    db.close()
+    db.enable_bulk_import()
+
+    try:
+        # this thread is the only writer to the database, the matches and the
+        # two-view geometries of each chunk are written in the same batch
+        starts = range(0, len(pairs_unique), chunk_size)
+        chunks = (pairs_unique[i:i+chunk_size] for i in starts)
+        for i, results in zip(tqdm(starts), read_matches_chunks(
+                matches_path, chunks, num_workers)):
+            items = []
+            for (id0, id1), (matches, scores) in zip(
+                    ids[i:i+chunk_size].tolist(), results):
+                if min_match_score:
+                    matches = matches[scores > min_match_score]
+                items.append((id0, id1, matches))
+            db.add_matches_many(items)
+            if skip_geometric_verification:
+                db.add_two_view_geometries_many(items)
+    finally:
+        db.disable_bulk_import()
+        db.close()
 
 
 def geometric_verification(database_path, pairs_path, verbose=False):
@@ -111,7 +171,7 @@ def run_triangulation(model_path, database_path, image_dir, reference_model,
 
 def main(sfm_dir, reference_model, image_dir, pairs, features, matches,
          skip_geometric_verification=False, min_match_score=None,
-         verbose=False):
+         verbose=False, chunk_size=1024, num_workers=0):
 
     assert reference_model.exists(), reference_model
     assert features.exists(), features
@@ -125,7 +185,8 @@ def main(sfm_dir, reference_model, image_dir, pairs, features, matches,
     image_ids = create_db_from_model(reference, database)
     import_features(image_ids, database, features)
     import_matches(image_ids, database, pairs, matches,
-                   min_match_score, skip_geometric_verification)
+                   min_match_score, skip_geometric_verification,
+                   chunk_size, num_workers)
     if not skip_geometric_verification:
         geometric_verification(database, pairs, verbose)
     reconstruction = run_triangulation(sfm_dir, database, image_dir, reference,
@@ -147,6 +208,10 @@ if __name__ == '__main__':
 
     parser.add_argument('--skip_geometric_verification', action='store_true')
     parser.add_argument('--min_match_score', type=float)
+    parser.add_argument('--chunk_size', type=int, default=1024,
+                        help='number of pairs imported at once')
+    parser.add_argument('--num_workers', type=int, default=0,
+                        help='number of threads reading the matches')
     parser.add_argument('--verbose', action='store_true')
     args = parser.parse_args()
 
@@ -0,0 +1,44 @@
+'''
+Files made of a JSON header followed by binary data aligned to 64 bytes,
+such that the data can be memory-mapped, with the layout:
+    - magic string of the type of file and format version (uint32),
+    - length (uint32) and content of the JSON header,
+    - the data, from the first aligned offset after the header.
+'''
+from typing import BinaryIO, Dict
+from pathlib import Path
+import json
+import struct
+
+ALIGNMENT = 64
+
+
+def get_offset(start: int) -> int:
+    return -(-start // ALIGNMENT) * ALIGNMENT
+
+
+def read_header(path: Path, magic: bytes, version: int,
+                description: str) -> Dict:
+    '''Read the header of a file, with the offset of its data.'''
+    with open(str(path), 'rb') as f:
+        if f.read(len(magic)) != magic:
+            raise ValueError(f'{path} is not a {description}.')
+        file_version, size = struct.unpack('<II', f.read(8))
+        if file_version != version:
+            raise ValueError(
+                f'{description.capitalize()} {path} has version '
+                f'{file_version}, expected {version}.')
+        header = json.loads(f.read(size).decode('utf-8'))
+    header['offset'] = get_offset(len(magic) + 8 + size)
+    return header
+
+
+def write_header(f: BinaryIO, magic: bytes, version: int,
+                 header: Dict) -> int:
+    '''Write the header and return the aligned offset of the data.'''
+    meta = json.dumps(header).encode('utf-8')
+    start = len(magic) + 8 + len(meta)
+    offset = get_offset(start)
+    f.write(magic + struct.pack('<II', version, len(meta)) + meta)
+    f.write(b'\0' * (offset - start))
+    return offset
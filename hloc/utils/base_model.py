@@ -8,6 +8,8 @@ import inspect
 class BaseModel(nn.Module, metaclass=ABCMeta):
     default_conf = {}
     required_inputs = []
+    # Whether _forward handles inputs with a batch dimension larger than 1.
+    supports_batching = False
 
     def __init__(self, conf):
         """Perform some logic and call the _init method of the child model."""
@@ -0,0 +1,353 @@
+'''
+A columnar copy of a COLMAP model, with the attributes of all the images and
+3D points in contiguous arrays instead of one namedtuple per element:
+    - images: ids, qvecs, tvecs, camera_ids and names (one per row), and the
+      2D points xys, point3D_ids of all the images concatenated, delimited
+      by the offsets points2D_ptr,
+    - points3D: ids, xyz, rgb, error (one per row), and the tracks
+      image_ids, point2D_idxs of all the points concatenated, delimited by
+      the offsets track_ptr,
+    - cameras: the dict of Camera, which is small,
+    - covisibility: optionally, the graph of the images that observe common
+      3D points, as the CSR offsets ptr and columns rows, indexed by rows.
+The model can be saved to a single file that is memory-mapped when loaded,
+e.g. sfm/hloc_columns.bin, in the layout of aligned_file: a JSON header with
+the cameras, the image names, the dtype, shape and offset of each array,
+and the size and modification time of the source model files, followed by
+the arrays, each aligned to 64 bytes.
+'''
+import argparse
+from typing import Dict, List, Optional, Tuple
+from pathlib import Path
+import logging
+import os
+import numpy as np
+from scipy.sparse import csr_matrix, vstack
+
+from . import aligned_file
+from .aligned_file import get_offset
+from .read_write_model import (
+    Camera, Image, Point3D, detect_model_format, read_model,
+    read_cameras_binary, read_images_binary, read_points3D_binary,
+    qvec2rotmat, images_to_columns, images_from_columns,
+    points3D_to_columns, points3D_from_columns)
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'HLOCCOLS'
+VERSION = 1
+CACHE_NAME = 'hloc_columns.bin'
+
+
+def get_model_stat(path: Path) -> Optional[List[int]]:
+    '''Size and modification time of the files of a COLMAP model.'''
+    for ext in ['.bin', '.txt']:
+        if detect_model_format(str(path), ext):
+            stats = [Path(path, n + ext).stat()
+                     for n in ['cameras', 'images', 'points3D']]
+            return [x for s in stats for x in (s.st_size, s.st_mtime_ns)]
+    return None
+
+
+class IdLookup:
+    '''Map ids to their rows, with a table indexed by id if the ids are
+       dense enough, otherwise by binary search. Unknown ids raise a
+       KeyError.'''
+    def __init__(self, ids: np.ndarray):
+        ids = np.asarray(ids, np.int64)
+        self.table = self.order = None
+        if len(ids) > 0 and ids.min() >= 0 and ids.max() < 4*len(ids) + 1024:
+            self.table = np.full(ids.max() + 1, -1, np.int64)
+            self.table[ids] = np.arange(len(ids))
+        else:
+            self.order = np.argsort(ids)
+            self.sorted_ids = ids[self.order]
+
+    def __call__(self, ids) -> np.ndarray:
+        ids = np.asarray(ids, np.int64)
+        if self.table is not None:
+            valid = (ids >= 0) & (ids < len(self.table))
+            rows = self.table[np.where(valid, ids, 0)]
+            valid &= rows >= 0
+        else:
+            pos = np.searchsorted(self.sorted_ids, ids)
+            valid = np.asarray(pos < len(self.sorted_ids))
+            valid[valid] = self.sorted_ids[pos[valid]] == ids[valid]
+        if not np.all(valid):
+            raise KeyError(np.unique(ids[~valid]).tolist())
+        return rows if self.table is not None else self.order[pos]
+
+
+class ColumnarModel:
+    '''Arrays of the images and 3D points of a COLMAP model, see the module
+       docstring. The rows of the images and of the 3D points follow the
+       order of the model files, not that of their ids.'''
+    image_keys = ['ids', 'qvecs', 'tvecs', 'camera_ids', 'points2D_ptr',
+                  'xys', 'point3D_ids']
+    point3D_keys = ['ids', 'xyz', 'rgb', 'error', 'track_ptr', 'image_ids',
+                    'point2D_idxs']
+
+    covisibility_keys = ['ptr', 'rows']
+
+    def __init__(self, cameras: Dict[int, Camera], images: Dict,
+                 points3D: Dict, covisibility: Optional[Dict] = None):
+        self.cameras = cameras
+        self.images = images
+        self.points3D = points3D
+        self.covisibility = covisibility
+        self._image_lookup = None
+        self._point3D_lookup = None
+        self._covisibility_graph = None
+
+    @classmethod
+    def from_model(cls, cameras: Dict, images: Dict,
+                   points3D: Dict) -> 'ColumnarModel':
+        '''Convert the dicts of namedtuples returned by read_model.'''
+        return cls(cameras, images_to_columns(images),
+                   points3D_to_columns(points3D))
+
+    @classmethod
+    def from_reconstruction(cls, reconstruction) -> 'ColumnarModel':
+        '''Convert a pycolmap.Reconstruction.'''
+        cameras = {
+            i: Camera(id=i, model=c.model_name, width=c.width,
+                      height=c.height, params=np.asarray(c.params))
+            for i, c in reconstruction.cameras.items()}
+        images = {
+            i: Image(id=i, qvec=image.qvec, tvec=image.tvec,
+                     camera_id=image.camera_id, name=image.name,
+                     xys=np.array([p.xy for p in image.points2D]),
+                     point3D_ids=np.array(
+                         [p.point3D_id if p.has_point3D() else -1
+                          for p in image.points2D], np.int64))
+            for i, image in reconstruction.images.items()}
+        points3D = {
+            i: Point3D(id=i, xyz=p.xyz, rgb=p.color, error=p.error,
+                       image_ids=np.array(
+                           [el.image_id for el in p.track.elements]),
+                       point2D_idxs=np.array(
+                           [el.point2D_idx for el in p.track.elements]))
+            for i, p in reconstruction.points3D.items()}
+        return cls.from_model(cameras, images, points3D)
+
+    @classmethod
+    def read(cls, path: Path) -> 'ColumnarModel':
+        '''Read the files of a COLMAP model, parsing binary files directly
+           into columns.'''
+        if detect_model_format(str(path), '.bin'):
+            return cls(
+                read_cameras_binary(str(Path(path, 'cameras.bin'))),
+                read_images_binary(str(Path(path, 'images.bin')), True),
+                read_points3D_binary(str(Path(path, 'points3D.bin')), True))
+        return cls.from_model(*read_model(str(path)))
+
+    def to_model(self) -> Tuple[Dict, Dict, Dict]:
+        '''Convert back to the dicts of namedtuples of read_model.'''
+        return (self.cameras, images_from_columns(self.images),
+                points3D_from_columns(self.points3D))
+
+    @property
+    def num_images(self) -> int:
+        return len(self.images['ids'])
+
+    @property
+    def num_points3D(self) -> int:
+        return len(self.points3D['ids'])
+
+    def image_rows(self, image_ids) -> np.ndarray:
+        if self._image_lookup is None:
+            self._image_lookup = IdLookup(self.images['ids'])
+        return self._image_lookup(image_ids)
+
+    def point3D_rows(self, point3D_ids) -> np.ndarray:
+        if self._point3D_lookup is None:
+            self._point3D_lookup = IdLookup(self.points3D['ids'])
+        return self._point3D_lookup(point3D_ids)
+
+    def rotations(self) -> np.ndarray:
+        '''World-to-camera rotation matrices of all the images, Nx3x3.'''
+        return qvec2rotmat(self.images['qvecs'].T).transpose(2, 0, 1)
+
+    def camera_centers(self) -> np.ndarray:
+        '''Positions of all the cameras in the world frame, Nx3.'''
+        return -np.einsum('nji,nj->ni', self.rotations(), self.images['tvecs'])
+
+    def covisibility_graph(self, chunk_size: int = 128) -> csr_matrix:
+        '''Graph of the images that observe common 3D points, indexed by
+           rows. It is computed by chunks of rows on the first call.'''
+        if self.covisibility is None:
+            graph = vstack([
+                get_covisibility_counts(
+                    self, start, min(start + chunk_size, self.num_images))
+                for start in range(0, self.num_images, chunk_size)]
+                + [csr_matrix((0, self.num_images), dtype=np.int32)],
+                format='csr')
+            self.covisibility = {'ptr': graph.indptr.astype(np.int64),
+                                 'rows': graph.indices.astype(np.int64)}
+        if self._covisibility_graph is None:
+            rows = self.covisibility['rows']
+            self._covisibility_graph = csr_matrix(
+                (np.ones(len(rows), bool), rows, self.covisibility['ptr']),
+                shape=(self.num_images, self.num_images))
+        return self._covisibility_graph
+
+    def arrays(self) -> Dict[str, np.ndarray]:
+        arrays = {**{f'images/{k}': self.images[k] for k in self.image_keys},
+                  **{f'points3D/{k}': self.points3D[k]
+                     for k in self.point3D_keys}}
+        if self.covisibility is not None:
+            arrays.update({f'covisibility/{k}': self.covisibility[k]
+                           for k in self.covisibility_keys})
+        return arrays
+
+    def save(self, path: Path, **extra):
+        '''Write all the arrays to a single file, extra is added to the
+           header.'''
+        arrays = self.arrays()
+        layout = {}
+        offset = 0
+        for key, array in arrays.items():
+            layout[key] = {'dtype': array.dtype.str, 'shape': array.shape,
+                           'offset': offset}
+            offset = get_offset(offset + array.nbytes)
+        header = {
+            'cameras': [[int(c.id), c.model, int(c.width), int(c.height),
+                         np.asarray(c.params).tolist()]
+                        for c in self.cameras.values()],
+            'names': list(self.images['names']),
+            'arrays': layout, **extra}
+
+        tmp_path = Path(str(path) + '.tmp')
+        with open(str(tmp_path), 'wb') as f:
+            start = aligned_file.write_header(f, MAGIC, VERSION, header)
+            for key, array in arrays.items():
+                f.seek(start + layout[key]['offset'])
+                np.ascontiguousarray(array).tofile(f)
+            f.truncate(start + offset)
+        os.replace(str(tmp_path), str(path))
+
+    @classmethod
+    def load(cls, path: Path, mmap_mode: str = 'c') -> 'ColumnarModel':
+        '''Memory-map the arrays of a saved model, copy-on-write by default,
+           such that only the accessed pages are read.'''
+        header = read_header(path)
+        arrays = {}
+        for key, spec in header['arrays'].items():
+            shape = tuple(spec['shape'])
+            if int(np.prod(shape)) == 0:  # empty arrays cannot be mapped
+                arrays[key] = np.zeros(shape, spec['dtype'])
+            else:
+                arrays[key] = np.memmap(
+                    str(path), mode=mmap_mode, dtype=spec['dtype'],
+                    offset=header['offset'] + spec['offset'], shape=shape)
+        cameras = {i: Camera(id=i, model=model, width=width, height=height,
+                             params=np.array(params))
+                   for i, model, width, height, params in header['cameras']}
+        images = {k: arrays[f'images/{k}'] for k in cls.image_keys}
+        images['names'] = header['names']
+        points3D = {k: arrays[f'points3D/{k}'] for k in cls.point3D_keys}
+        covisibility = None
+        if 'covisibility/ptr' in arrays:
+            covisibility = {k: arrays[f'covisibility/{k}']
+                            for k in cls.covisibility_keys}
+        return cls(cameras, images, points3D, covisibility)
+
+
+def get_covisibility_counts(model: ColumnarModel, start: int,
+                            end: int) -> csr_matrix:
+    '''Number of 3D points shared by the images of rows [start, end) and all
+       the images, as the block of rows of A.A^T, with A the images x points
+       incidence matrix. Only the observations of the block are read.'''
+    ptr = model.images['points2D_ptr']
+    point3D_ids = np.asarray(model.images['point3D_ids'][ptr[start]:ptr[end]])
+    rows = np.repeat(np.arange(end - start), np.diff(ptr[start:end+1]))
+    valid = point3D_ids != -1
+    rows = rows[valid]
+    point3D_rows = model.point3D_rows(point3D_ids[valid])
+
+    # gather the tracks of all the observed points at once
+    starts = model.points3D['track_ptr'][point3D_rows]
+    lengths = model.points3D['track_ptr'][point3D_rows + 1] - starts
+    idxs = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + \
+        np.arange(lengths.sum())
+    rows = np.repeat(rows, lengths)
+    covis_rows = model.image_rows(model.points3D['image_ids'][idxs])
+    other = covis_rows != rows + start
+    rows, covis_rows = rows[other], covis_rows[other]
+
+    # duplicate entries are summed
+    counts = csr_matrix(
+        (np.ones(len(rows), np.int32), (rows, covis_rows)),
+        shape=(end - start, model.num_images))
+    counts.sum_duplicates()
+    return counts
+
+
+def read_header(path: Path) -> Dict:
+    return aligned_file.read_header(path, MAGIC, VERSION, 'columnar model')
+
+
+def load_columnar_model(path: Path, cache: bool = False,
+                        covisibility: bool = False) -> ColumnarModel:
+    '''Load a COLMAP model in columns. path is either a saved columnar model
+       or a model directory, in which case its cached columnar copy is used
+       if it is up to date. If cache, the copy is written when missing. If
+       covisibility, the covisibility graph is computed when missing from
+       the copy, and added to it if cache.'''
+    path = Path(path)
+    if path.is_file():
+        model = ColumnarModel.load(path)
+        if covisibility:
+            model.covisibility_graph()
+        return model
+    stat = get_model_stat(path)
+    cache_path = path / CACHE_NAME
+    model = None
+    if stat is not None and cache_path.exists():
+        try:
+            header = read_header(cache_path)
+        except ValueError as error:
+            header = {}
+            logger.warning(f'{error} Ignoring it.')
+        if header.get('model_stat') == stat:
+            model = ColumnarModel.load(cache_path)
+            if not covisibility or model.covisibility is not None:
+                return model
+        else:
+            logger.info('The columnar copy of the model is outdated.')
+
+    if model is None:
+        model = ColumnarModel.read(path)
+    if covisibility:
+        logger.info('Computing the covisibility graph of the model...')
+        model.covisibility_graph()
+    if cache and stat is not None:
+        try:
+            model.save(cache_path, model_stat=stat)
+        except OSError as error:
+            logger.warning(f'Could not cache the columnar model: {error}')
+    return model
+
+
+def main(model: Path, output: Optional[Path] = None,
+         covisibility: bool = False):
+    if output is None:
+        output = model / CACHE_NAME
+    logger.info(f'Writing the columnar copy of model {model} to {output}...')
+    stat = get_model_stat(model)
+    columns = ColumnarModel.read(model)
+    if covisibility:
+        columns.covisibility_graph()
+    columns.save(output, **({} if stat is None else {'model_stat': stat}))
+    logger.info('Done!')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', type=Path, required=True)
+    parser.add_argument('--output', type=Path)
+    parser.add_argument('--covisibility', action='store_true',
+                        help='also store the covisibility graph of the '
+                        'images, used by localize_sfm')
+    args = parser.parse_args()
+    main(**args.__dict__)
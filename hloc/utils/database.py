@@ -118,6 +118,14 @@ def image_ids_to_pair_id(image_id1, image_id2):
     return image_id1 * MAX_IMAGE_ID + image_id2
 
 
+def image_ids_to_pair_ids(image_ids1, image_ids2):
+    """Vectorized image_ids_to_pair_id for arrays of image ids."""
+    image_ids1 = np.asarray(image_ids1, np.int64)
+    image_ids2 = np.asarray(image_ids2, np.int64)
+    return (np.minimum(image_ids1, image_ids2) * MAX_IMAGE_ID
+            + np.maximum(image_ids1, image_ids2))
+
+
 def pair_id_to_image_ids(pair_id):
     image_id2 = pair_id % MAX_IMAGE_ID
     image_id1 = (pair_id - image_id2) / MAX_IMAGE_ID
@@ -138,6 +146,48 @@ def blob_to_array(blob, dtype, shape=(-1,)):
         return np.frombuffer(blob, dtype=dtype).reshape(*shape)
 
 
+def keypoints_to_row(image_id, keypoints):
+    assert(len(keypoints.shape) == 2)
+    assert(keypoints.shape[1] in [2, 4, 6])
+
+    keypoints = np.asarray(keypoints, np.float32)
+    return (image_id,) + keypoints.shape + (array_to_blob(keypoints),)
+
+
+def matches_to_row(image_id1, image_id2, matches):
+    assert(len(matches.shape) == 2)
+    assert(matches.shape[1] == 2)
+
+    if image_id1 > image_id2:
+        matches = matches[:,::-1]
+
+    pair_id = image_ids_to_pair_id(image_id1, image_id2)
+    matches = np.asarray(matches, np.uint32)
+    return (pair_id,) + matches.shape + (array_to_blob(matches),)
+
+
+def two_view_geometry_to_row(image_id1, image_id2, matches,
+                             F=np.eye(3), E=np.eye(3), H=np.eye(3),
+                             qvec=np.array([1.0, 0.0, 0.0, 0.0]),
+                             tvec=np.zeros(3), config=2):
+    assert(len(matches.shape) == 2)
+    assert(matches.shape[1] == 2)
+
+    if image_id1 > image_id2:
+        matches = matches[:,::-1]
+
+    pair_id = image_ids_to_pair_id(image_id1, image_id2)
+    matches = np.asarray(matches, np.uint32)
+    F = np.asarray(F, dtype=np.float64)
+    E = np.asarray(E, dtype=np.float64)
+    H = np.asarray(H, dtype=np.float64)
+    qvec = np.asarray(qvec, dtype=np.float64)
+    tvec = np.asarray(tvec, dtype=np.float64)
+    return (pair_id,) + matches.shape + (array_to_blob(matches), config,
+            array_to_blob(F), array_to_blob(E), array_to_blob(H),
+            array_to_blob(qvec), array_to_blob(tvec))
+
+
 class COLMAPDatabase(sqlite3.Connection):
 
     @staticmethod
@@ -173,7 +223,7 @@ class COLMAPDatabase(sqlite3.Connection):
         return cursor.lastrowid
 
     def add_image(self, name, camera_id,
-                  prior_q=np.full(4, np.NaN), prior_t=np.full(3, np.NaN),
+                  prior_q=np.full(4, np.nan), prior_t=np.full(3, np.nan),
                   image_id=None):
         cursor = self.execute(
             "INSERT INTO images VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
@@ -182,13 +232,15 @@ class COLMAPDatabase(sqlite3.Connection):
         return cursor.lastrowid
 
     def add_keypoints(self, image_id, keypoints):
-        assert(len(keypoints.shape) == 2)
-        assert(keypoints.shape[1] in [2, 4, 6])
-
-        keypoints = np.asarray(keypoints, np.float32)
         self.execute(
             "INSERT INTO keypoints VALUES (?, ?, ?, ?)",
-            (image_id,) + keypoints.shape + (array_to_blob(keypoints),))
+            keypoints_to_row(image_id, keypoints))
+
+    def add_keypoints_many(self, items):
+        """Insert the (image_id, keypoints) of an iterable in one statement."""
+        self.executemany(
+            "INSERT INTO keypoints VALUES (?, ?, ?, ?)",
+            (keypoints_to_row(*item) for item in items))
 
     def add_descriptors(self, image_id, descriptors):
         descriptors = np.ascontiguousarray(descriptors, np.uint8)
@@ -197,40 +249,48 @@ class COLMAPDatabase(sqlite3.Connection):
             (image_id,) + descriptors.shape + (array_to_blob(descriptors),))
 
     def add_matches(self, image_id1, image_id2, matches):
-        assert(len(matches.shape) == 2)
-        assert(matches.shape[1] == 2)
-
-        if image_id1 > image_id2:
-            matches = matches[:,::-1]
-
-        pair_id = image_ids_to_pair_id(image_id1, image_id2)
-        matches = np.asarray(matches, np.uint32)
         self.execute(
             "INSERT INTO matches VALUES (?, ?, ?, ?)",
-            (pair_id,) + matches.shape + (array_to_blob(matches),))
+            matches_to_row(image_id1, image_id2, matches))
+
+    def add_matches_many(self, items):
+        """Insert the (image_id1, image_id2, matches) of an iterable
+        in one statement."""
+        self.executemany(
+            "INSERT INTO matches VALUES (?, ?, ?, ?)",
+            (matches_to_row(*item) for item in items))
 
     def add_two_view_geometry(self, image_id1, image_id2, matches,
                               F=np.eye(3), E=np.eye(3), H=np.eye(3),
                               qvec=np.array([1.0, 0.0, 0.0, 0.0]),
                               tvec=np.zeros(3), config=2):
-        assert(len(matches.shape) == 2)
-        assert(matches.shape[1] == 2)
-
-        if image_id1 > image_id2:
-            matches = matches[:,::-1]
-
-        pair_id = image_ids_to_pair_id(image_id1, image_id2)
-        matches = np.asarray(matches, np.uint32)
-        F = np.asarray(F, dtype=np.float64)
-        E = np.asarray(E, dtype=np.float64)
-        H = np.asarray(H, dtype=np.float64)
-        qvec = np.asarray(qvec, dtype=np.float64)
-        tvec = np.asarray(tvec, dtype=np.float64)
         self.execute(
             "INSERT INTO two_view_geometries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-            (pair_id,) + matches.shape + (array_to_blob(matches), config,
-             array_to_blob(F), array_to_blob(E), array_to_blob(H),
-             array_to_blob(qvec), array_to_blob(tvec)))
+            two_view_geometry_to_row(image_id1, image_id2, matches,
+                                     F, E, H, qvec, tvec, config))
+
+    def add_two_view_geometries_many(self, items):
+        """Insert the (image_id1, image_id2, matches) of an iterable as
+        two-view geometries with default parameters in one statement."""
+        self.executemany(
+            "INSERT INTO two_view_geometries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (two_view_geometry_to_row(*item) for item in items))
+
+    def enable_bulk_import(self):
+        """Speed up large imports: write-ahead logging without syncing to
+        disk, at the risk of corrupting the database if the system crashes,
+        and larger caches. Call disable_bulk_import when done."""
+        self.execute("PRAGMA journal_mode=WAL")
+        self.execute("PRAGMA synchronous=OFF")
+        self.execute("PRAGMA temp_store=MEMORY")
+        self.execute("PRAGMA cache_size=-262144")  # in KiB
+
+    def disable_bulk_import(self):
+        """Restore the default journaling, such that the database is a
+        single file again."""
+        self.commit()
+        self.execute("PRAGMA journal_mode=DELETE")
+        self.execute("PRAGMA synchronous=FULL")
 
 
 def example_usage():
@@ -0,0 +1,150 @@
+'''
+A compact, memory-mappable copy of the global descriptors of an HDF5 feature
+file. The store is a single file written next to the features, e.g.
+global-feats-netvlad.h5 -> global-feats-netvlad.desc, with the layout:
+    - magic string and format version (uint32),
+    - length (uint32) and content of a JSON header with the dtype and shape
+      of the matrix, the image names (one per row), and the size and
+      modification time of the source feature file,
+    - the contiguous descriptor matrix, aligned to 64 bytes.
+'''
+import argparse
+from typing import Dict, List, Optional
+from pathlib import Path
+import logging
+import os
+import h5py
+import numpy as np
+
+from . import aligned_file
+from .io import list_h5_names
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'HLOCDESC'
+VERSION = 1
+
+
+def get_store_path(feature_path: Path) -> Path:
+    return Path(feature_path).with_suffix('.desc')
+
+
+def get_source_stat(feature_path: Path) -> Dict:
+    stat = os.stat(str(feature_path))
+    return {'source_size': stat.st_size, 'source_mtime_ns': stat.st_mtime_ns}
+
+
+def read_header(path: Path) -> Dict:
+    return aligned_file.read_header(path, MAGIC, VERSION, 'descriptor store')
+
+
+def write_header(f, header: Dict) -> int:
+    '''Write the header and return the aligned offset of the matrix.'''
+    return aligned_file.write_header(f, MAGIC, VERSION, header)
+
+
+class DescriptorStore:
+    '''Read-only view of a descriptor store. The matrix is memory-mapped
+       copy-on-write, so it can be wrapped by torch.from_numpy without copy.'''
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.header = read_header(self.path)
+        self.names = self.header['names']
+        self.name2idx = {n: i for i, n in enumerate(self.names)}
+        self.matrix = np.memmap(
+            str(self.path), mode='c', offset=self.header['offset'],
+            dtype=self.header['dtype'], shape=tuple(self.header['shape']))
+
+    def __len__(self):
+        return len(self.names)
+
+    def is_fresh(self, feature_path: Path) -> bool:
+        '''Check that the store was built from the current feature file.'''
+        stat = get_source_stat(feature_path)
+        return all(self.header.get(k) == v for k, v in stat.items())
+
+    def get(self, names: List[str]) -> np.ndarray:
+        '''Return the descriptors of names, without copy if they form a
+           contiguous range of rows.'''
+        idxs = np.array([self.name2idx[n] for n in names], dtype=np.int64)
+        if len(idxs) > 0 and \
+                np.array_equal(idxs, np.arange(idxs[0], idxs[0]+len(idxs))):
+            return self.matrix[idxs[0]:idxs[0]+len(idxs)]
+        return self.matrix[idxs]
+
+
+def load_descriptor_store(feature_path: Path,
+                          key: str = 'global_descriptor'
+                          ) -> Optional[DescriptorStore]:
+    '''Open the store of a feature file if it exists and is up to date.'''
+    path = get_store_path(feature_path)
+    if not path.exists():
+        return None
+    try:
+        store = DescriptorStore(path)
+    except ValueError as error:
+        logger.warning(f'{error} Ignoring it.')
+        return None
+    if store.header['key'] != key:
+        return None
+    if not store.is_fresh(feature_path):
+        logger.info(f'Descriptor store {path.name} is outdated, ignoring it.')
+        return None
+    return store
+
+
+def write_descriptor_store(feature_path: Path,
+                           output: Optional[Path] = None,
+                           key: str = 'global_descriptor',
+                           dtype: Optional[str] = None,
+                           chunk_size: int = 4096) -> Path:
+    '''Copy the descriptors of a feature file into a store. The matrix is
+       filled in chunks, so the descriptors never need to fit in memory.'''
+    if output is None:
+        output = get_store_path(feature_path)
+    names = sorted(list_h5_names(feature_path))
+    tmp_path = Path(str(output) + '.tmp')
+    with h5py.File(str(feature_path), 'r') as fd:
+        first = fd[names[0]][key]
+        shape = (len(names),) + first.shape
+        dtype = np.dtype(dtype or first.dtype)
+        header = {
+            'dtype': dtype.name, 'shape': shape, 'key': key, 'names': names,
+            **get_source_stat(feature_path)}
+        with open(str(tmp_path), 'wb') as f:
+            offset = write_header(f, header)
+            f.truncate(offset + dtype.itemsize * int(np.prod(shape)))
+        matrix = np.memmap(str(tmp_path), mode='r+', offset=offset,
+                           dtype=dtype, shape=shape)
+        for start in range(0, len(names), chunk_size):
+            matrix[start:start+chunk_size] = np.stack(
+                [fd[n][key].__array__()
+                 for n in names[start:start+chunk_size]]).astype(dtype)
+        matrix.flush()
+        del matrix
+    os.replace(str(tmp_path), str(output))
+    return output
+
+
+def main(feature_path: Path, output: Optional[Path] = None,
+         key: str = 'global_descriptor', dtype: Optional[str] = None,
+         overwrite: bool = False) -> Path:
+    if output is None:
+        output = get_store_path(feature_path)
+    if not overwrite and output == get_store_path(feature_path) and \
+            load_descriptor_store(feature_path, key) is not None:
+        logger.info(f'Descriptor store {output.name} is up to date.')
+        return output
+    logger.info(f'Writing the descriptor store {output.name}...')
+    return write_descriptor_store(feature_path, output, key, dtype)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--feature_path', type=Path, required=True)
+    parser.add_argument('--output', type=Path)
+    parser.add_argument('--key', type=str, default='global_descriptor')
+    parser.add_argument('--dtype', type=str, choices=['float16', 'float32'])
+    parser.add_argument('--overwrite', action='store_true')
+    args = parser.parse_args()
+    main(**args.__dict__)
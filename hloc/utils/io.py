@@ -1,11 +1,19 @@
-from typing import Tuple
+from typing import Dict, List, Optional, Tuple
+from collections import OrderedDict
 from pathlib import Path
+import logging
+import queue
+import threading
+import time
 import numpy as np
 import cv2
 import h5py
+import PIL.Image
 
 from .parsers import names_to_pair, names_to_pair_old
 
+logger = logging.getLogger(__name__)
+
 
 def read_image(path, grayscale=False):
     if grayscale:
@@ -20,14 +28,73 @@ def read_image(path, grayscale=False):
     return image
 
 
-def list_h5_names(path):
+EXIF_ORIENTATION = 0x0112
+
+
+def get_image_size(path):
+    '''Return the (width, height) of an image by only reading its header.
+       As cv2.imread, apply the EXIF orientation, which transposes the image
+       for orientations 5 to 8.'''
+    with PIL.Image.open(str(path)) as image:
+        width, height = image.size
+        if image.getexif().get(EXIF_ORIENTATION, 1) in (5, 6, 7, 8):
+            width, height = height, width
+    return width, height
+
+
+# Root dataset of the names of the groups written to a file, such that they
+# can be listed without visiting all its datasets.
+NAMES_INDEX = '__names__'
+
+
+def scan_h5_names(fd: h5py.File) -> List[str]:
     names = []
+
+    def visit_fn(name, obj):
+        if isinstance(obj, h5py.Dataset) and name != NAMES_INDEX:
+            names.append(obj.parent.name.strip('/'))
+    fd.visititems(visit_fn)
+    return names
+
+
+def read_names_index(fd: h5py.File) -> Optional[List[str]]:
+    if NAMES_INDEX not in fd:
+        return None
+    return list(fd[NAMES_INDEX].asstr()[()])
+
+
+class NamesIndex:
+    '''Incrementally updated index of the names of a file opened for
+       writing. It is created from a scan of the file if it is missing,
+       e.g. for files written by older versions.'''
+    def __init__(self, fd: h5py.File):
+        self.fd = fd
+        names = read_names_index(fd)
+        if names is None:
+            names = scan_h5_names(fd)
+            fd.create_dataset(
+                NAMES_INDEX, shape=(0,), maxshape=(None,), chunks=(1024,),
+                dtype=h5py.string_dtype())
+        self.dataset = fd[NAMES_INDEX]
+        self.names = set(read_names_index(fd))
+        self.add(names)
+
+    def add(self, names: List[str]):
+        new = [n for n in dict.fromkeys(names) if n not in self.names]
+        if len(new) == 0:
+            return
+        size = len(self.dataset)
+        self.dataset.resize((size + len(new),))
+        self.dataset[size:] = new
+        self.names.update(new)
+
+
+def list_h5_names(path):
     with h5py.File(str(path), 'r') as fd:
-        def visit_fn(_, obj):
-            if isinstance(obj, h5py.Dataset):
-                names.append(obj.parent.name.strip('/'))
-        fd.visititems(visit_fn)
-    return list(set(names))
+        names = read_names_index(fd)
+        if names is None:
+            names = scan_h5_names(fd)
+    return list(dict.fromkeys(names))
 
 
 def get_keypoints(path: Path, name: str) -> np.ndarray:
@@ -55,14 +122,231 @@ def find_pair(hfile: h5py.File, name0: str, name1: str):
         'Maybe you matched with a different list of pairs? ')
 
 
-def get_matches(path: Path, name0: str, name1: str) -> Tuple[np.ndarray]:
-    with h5py.File(str(path), 'r') as hfile:
-        pair, reverse = find_pair(hfile, name0, name1)
-        matches = hfile[pair]['matches0'].__array__()
-        scores = hfile[pair]['matching_scores0'].__array__()
+def parse_matches(matches: np.ndarray, scores: np.ndarray,
+                  reverse: bool) -> Tuple[np.ndarray]:
     idx = np.where(matches != -1)[0]
     matches = np.stack([idx, matches[idx]], -1)
     if reverse:
         matches = np.flip(matches, -1)
     scores = scores[idx]
     return matches, scores
+
+
+def get_matches(path: Path, name0: str, name1: str) -> Tuple[np.ndarray]:
+    with h5py.File(str(path), 'r') as hfile:
+        pair, reverse = find_pair(hfile, name0, name1)
+        matches = hfile[pair]['matches0'].__array__()
+        scores = hfile[pair]['matching_scores0'].__array__()
+    return parse_matches(matches, scores, reverse)
+
+
+def read_dataset(fd: h5py.File, name: str) -> np.ndarray:
+    '''Read a whole dataset with the low-level API of h5py, which is several
+       times faster than the high-level objects for many small datasets.'''
+    dset = h5py.h5d.open(fd.id, name.encode())
+    array = np.empty(dset.shape, dset.dtype)
+    dset.read(h5py.h5s.ALL, h5py.h5s.ALL, array)
+    return array
+
+
+class MatchReader:
+    '''Read the matches of many pairs from a match file that stays open.
+       The names of the pairs in the file are read once, from its index if
+       it has one, so that each pair is resolved with set lookups instead
+       of probing the file with every candidate name.'''
+    def __init__(self, path: Path):
+        self.fd = h5py.File(str(path), 'r')
+        names = read_names_index(self.fd)
+        if names is None:
+            names = scan_h5_names(self.fd)
+        self.pairs = set(names)
+        self.cache = {}
+
+    def find_pair(self, name0: str, name1: str) -> Tuple[str, bool]:
+        for to_pair in (names_to_pair, names_to_pair_old):
+            for pair, reverse in ((to_pair(name0, name1), False),
+                                  (to_pair(name1, name0), True)):
+                if pair in self.pairs:
+                    return pair, reverse
+        raise ValueError(
+            f'Could not find pair {(name0, name1)}... '
+            'Maybe you matched with a different list of pairs? ')
+
+    def _read(self, pair: str, reverse: bool) -> Tuple[np.ndarray]:
+        return parse_matches(read_dataset(self.fd, f'{pair}/matches0'),
+                             read_dataset(self.fd, f'{pair}/matching_scores0'),
+                             reverse)
+
+    def get(self, name0: str, name1: str) -> Tuple[np.ndarray]:
+        return self._read(*self.find_pair(name0, name1))
+
+    def get_many(self, pairs: List[Tuple[str, str]]) -> List[Tuple]:
+        '''Return the matches and scores of a list of pairs, reading them
+           in the order of the file for a better locality.'''
+        results = [self.cache.get(tuple(p)) for p in pairs]
+        todo = [i for i, r in enumerate(results) if r is None]
+        found = {i: self.find_pair(*pairs[i]) for i in todo}
+        for i in sorted(todo, key=lambda i: found[i][0]):
+            results[i] = self._read(*found[i])
+        return results
+
+    def prefetch(self, pairs: List[Tuple[str, str]]) -> List[Tuple]:
+        '''Read pairs and keep them in memory for the next reads, until
+           clear_cache is called.'''
+        results = self.get_many(pairs)
+        self.cache.update(zip(map(tuple, pairs), results))
+        return results
+
+    def clear_cache(self):
+        self.cache = {}
+
+    def close(self):
+        self.fd.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class FeatureCache:
+    '''Read the features of images stored in several HDF5 files.
+       The files stay open until the cache is closed and the features of
+       the cache_size most recently used images are kept in memory.'''
+    def __init__(self, paths: List[Path], cache_size: int = 128):
+        self.files = {}
+        for path in paths:
+            if str(path) not in self.files:
+                self.files[str(path)] = h5py.File(str(path), 'r')
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.num_hits = self.num_misses = 0
+
+    def get(self, path: Path, name: str) -> Dict[str, np.ndarray]:
+        key = (str(path), name)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            self.num_hits += 1
+            return self.cache[key]
+        self.num_misses += 1
+        grp = self.files[str(path)][name]
+        data = {k: v.__array__() for k, v in grp.items()}
+        if self.cache_size > 0:
+            self.cache[key] = data
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return data
+
+    def close(self):
+        for fd in self.files.values():
+            fd.close()
+        self.files = {}
+        self.cache.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class H5Writer:
+    '''Write groups of datasets to an HDF5 file from a background thread.
+       The file stays open for the lifetime of the writer. Queued groups are
+       written in chunks and the file is flushed to disk every
+       flush_interval seconds and when the writer is closed, such that an
+       interrupted run only loses the groups of the last interval.'''
+    def __init__(self, path: Path, flush_interval: float = 10.,
+                 max_queue_size: int = 64, chunk_size: int = 16):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.chunk_size = chunk_size
+        self.fd = h5py.File(str(path), 'a')
+        self.index = NamesIndex(self.fd)
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def write(self, name: str, data: Dict[str, np.ndarray],
+              attrs: Optional[Dict[str, Dict]] = None):
+        '''Queue a group of datasets, replacing any existing group name.
+           attrs optionally maps dataset names to their attributes.'''
+        if self.error is not None:
+            raise self.error
+        self.queue.put((name, data, attrs or {}))
+
+    def _write(self, name, data, attrs):
+        # an existing group is only replaced once the new one is complete,
+        # such that a failed write does not remove an indexed group
+        tmp_name = name + '.partial' if name in self.fd else name
+        if tmp_name in self.fd:
+            del self.fd[tmp_name]
+        grp = self.fd.create_group(tmp_name)
+        try:
+            for k, v in data.items():
+                grp.create_dataset(k, data=v)
+            for k, attrs_k in attrs.items():
+                grp[k].attrs.update(attrs_k)
+        except Exception as error:
+            if isinstance(error, OSError) and \
+                    'No space left on device' in str(error):
+                logger.error(
+                    'Out of disk space: storing features on disk can take '
+                    'significant space, did you enable the as_half flag?')
+            del grp, self.fd[tmp_name]
+            raise error
+        if tmp_name != name:
+            del self.fd[name]
+            self.fd.move(tmp_name, name)
+
+    def _run(self):
+        last_flush = time.time()
+        done = False
+        while not done:
+            items = [self.queue.get()]
+            while len(items) < self.chunk_size:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            written = []
+            for item in items:
+                if item is None:
+                    done = True
+                    break
+                # Keep consuming the queue after a failure to not block
+                # the producer, the error is raised on the next write.
+                if self.error is None:
+                    try:
+                        self._write(*item)
+                        written.append(item[0])
+                    except Exception as error:
+                        self.error = error
+            try:
+                self.index.add(written)
+                flush_due = time.time() - last_flush > self.flush_interval
+                if self.error is None and (done or flush_due):
+                    self.fd.flush()
+                    last_flush = time.time()
+            except Exception as error:
+                if self.error is None:
+                    self.error = error
+
+    def close(self, raise_error: bool = True):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.fd.close()
+        if self.error is not None:
+            if raise_error:
+                raise self.error
+            logger.error(f'Failed to write to {self.path}: {self.error!r}')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        # do not hide an exception raised in the body of the with block
+        self.close(raise_error=exc_type is None)
@@ -0,0 +1,196 @@
+'''
+Localization logs written one query at a time to an HDF5 file, such that
+they do not need to be held in memory and the log of a single query can be
+read without loading the others.
+
+Each query log is a group named after the query. Nested dicts are groups,
+arrays and homogeneous lists are datasets, ragged lists are stored as
+flat values with offsets, and lists of tuples of the same types as one
+column per field.
+The types of the original values are stored as attributes to restore them.
+'''
+from typing import Any, Dict, List, Optional
+from pathlib import Path
+import pickle
+import numpy as np
+import h5py
+
+from .io import NamesIndex, read_names_index
+
+TYPE = '__type__'
+
+
+def get_logs_path(results: Path) -> Path:
+    return Path(f'{results}_logs.h5')
+
+
+def as_array(value) -> Optional[np.ndarray]:
+    '''Convert a value to a numeric or string array, if it is homogeneous.'''
+    try:
+        arr = np.asarray(value)
+    except ValueError:  # ragged
+        return None
+    if arr.dtype.kind in 'biuf':
+        return arr
+    if arr.dtype.kind == 'U':
+        return arr.astype(h5py.string_dtype())
+    return None
+
+
+def write_value(parent: h5py.Group, key: str, value: Any):
+    if value is None:
+        parent.create_group(key).attrs[TYPE] = 'none'
+    elif isinstance(value, dict):
+        grp = parent.create_group(key, track_order=True)
+        grp.attrs[TYPE] = 'dict'
+        for k, v in value.items():
+            write_value(grp, str(k), v)
+    elif isinstance(value, np.ndarray) and as_array(value) is not None:
+        parent.create_dataset(key, data=as_array(value)).attrs[TYPE] = 'array'
+    elif isinstance(value, (list, tuple)):
+        write_sequence(parent, key, value)
+    elif isinstance(value, (bool, int, float, str, np.generic)):
+        if isinstance(value, np.generic):
+            value = value.item()
+        ds = parent.create_dataset(key, data=value)
+        ds.attrs[TYPE] = type(value).__name__
+    else:
+        ds = parent.create_dataset(key, data=np.void(pickle.dumps(value)))
+        ds.attrs[TYPE] = 'pickle'
+
+
+def write_sequence(parent: h5py.Group, key: str, value: List):
+    kind = type(value).__name__
+    arr = as_array(value) if len(value) > 0 else np.zeros(0)
+    if arr is not None:
+        parent.create_dataset(key, data=arr).attrs[TYPE] = kind
+        return
+
+    items = [as_array(v) if isinstance(v, (list, tuple, np.ndarray))
+             else None for v in value]
+    if all(i is not None and i.ndim == 1 and i.dtype.kind in 'biuf'
+           for i in items):
+        # ragged list of numbers: flat values and offsets
+        non_empty = [i for i in items if len(i) > 0]
+        dtype = np.result_type(*non_empty) if non_empty else np.float64
+        grp = parent.create_group(key)
+        item = 'array' if isinstance(value[0], np.ndarray) \
+            else type(value[0]).__name__
+        grp.attrs.update({TYPE: 'ragged', 'kind': kind, 'item': item})
+        grp.create_dataset('values', data=np.concatenate(
+            [np.zeros(0, dtype)] + [i.astype(dtype) for i in items]))
+        grp.create_dataset('offsets', data=np.cumsum(
+            [0] + [len(i) for i in items]))
+        return
+
+    field_types = [type(f) for f in value[0]] \
+        if type(value[0]) is tuple else None
+    if field_types is not None and all(
+            type(v) is tuple and [type(f) for f in v] == field_types
+            for v in value):
+        # list of tuples of the same types: one column per field
+        grp = parent.create_group(key)
+        grp.attrs.update({TYPE: 'records', 'kind': kind,
+                          'item': 'tuple',
+                          'num_fields': len(value[0])})
+        for c in range(len(value[0])):
+            write_sequence(grp, f'c{c}', [v[c] for v in value])
+        return
+
+    grp = parent.create_group(key)
+    grp.attrs[TYPE] = kind
+    for i, v in enumerate(value):
+        write_value(grp, str(i), v)
+
+
+SEQUENCE_TYPES = {'list': list, 'tuple': tuple, 'array': np.asarray}
+
+
+def read_value(node) -> Any:
+    t = node.attrs.get(TYPE)
+    if isinstance(node, h5py.Dataset):
+        if t == 'pickle':
+            return pickle.loads(node[()].tobytes())
+        if h5py.check_string_dtype(node.dtype) is not None:
+            value = node.asstr()[()]
+        else:
+            value = node[()]
+        if t == 'array':
+            return value
+        if t in ('list', 'tuple'):
+            return SEQUENCE_TYPES[t](value.tolist())
+        return {'bool': bool, 'int': int, 'float': float, 'str': str}[t](
+            value)
+
+    if t == 'none':
+        return None
+    if t == 'dict':
+        return {k: read_value(v) for k, v in node.items()}
+    if t == 'ragged':
+        values, offsets = node['values'][()], node['offsets'][()]
+        item = SEQUENCE_TYPES[node.attrs['item']]
+        return SEQUENCE_TYPES[node.attrs['kind']](
+            item(values[s:e].tolist()) if item is not np.asarray
+            else values[s:e] for s, e in zip(offsets[:-1], offsets[1:]))
+    if t == 'records':
+        columns = [read_value(node[f'c{c}'])
+                   for c in range(node.attrs['num_fields'])]
+        item = SEQUENCE_TYPES[node.attrs['item']]
+        return SEQUENCE_TYPES[node.attrs['kind']](
+            item(v) for v in zip(*columns))
+    return SEQUENCE_TYPES[t](read_value(node[str(i)])
+                             for i in range(len(node)))
+
+
+class LocLogWriter:
+    '''Append the logs of the queries to a new file, one at a time.'''
+    def __init__(self, path: Path, **attrs):
+        self.fd = h5py.File(str(path), 'w')
+        self.fd.attrs.update({k: str(v) for k, v in attrs.items()})
+        self.index = NamesIndex(self.fd)
+
+    def write(self, qname: str, log: Dict):
+        write_value(self.fd, qname, log)
+        self.index.add([qname])
+
+    def close(self):
+        self.fd.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class LocLogReader:
+    '''Random access to the logs of the queries, read on demand.'''
+    def __init__(self, path: Path):
+        self.fd = h5py.File(str(path), 'r')
+        self.attrs = dict(self.fd.attrs)
+        self.queries = read_names_index(self.fd)
+
+    def __getitem__(self, qname: str) -> Dict:
+        return read_value(self.fd[qname])
+
+    def __contains__(self, qname: str) -> bool:
+        return qname in self.fd
+
+    def __len__(self) -> int:
+        return len(self.queries)
+
+    def keys(self) -> List[str]:
+        return list(self.queries)
+
+    def load_all(self) -> Dict:
+        '''Read all the logs in the layout of the former pickle logs.'''
+        return {**self.attrs, 'loc': {q: self[q] for q in self.queries}}
+
+    def close(self):
+        self.fd.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -48,6 +48,17 @@ def parse_retrieval(path):
     return dict(retrieval)
 
 
+def parse_pairs(path):
+    pairs = []
+    with open(path, 'r') as f:
+        for p in f.read().rstrip('\n').split('\n'):
+            if len(p) == 0:
+                continue
+            name0, name1 = p.split()
+            pairs.append((name0, name1))
+    return pairs
+
+
 def names_to_pair(name0, name1, separator='/'):
     return separator.join((name0.replace('/', '-'), name1.replace('/', '-')))
 
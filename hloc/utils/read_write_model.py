@@ -101,6 +101,66 @@ def write_next_bytes(fid, data, format_char_sequence, endian_character="<"):
     fid.write(bytes)
 
 
+# Packed layouts of the fixed-size records of the binary files.
+CAMERA_PROPERTIES = np.dtype([
+    ("id", "<i4"), ("model_id", "<i4"), ("width", "<u8"), ("height", "<u8")])
+IMAGE_PROPERTIES = np.dtype([
+    ("id", "<i4"), ("qvec", "<f8", 4), ("tvec", "<f8", 3),
+    ("camera_id", "<i4")])
+POINT2D = np.dtype([("xy", "<f8", 2), ("point3D_id", "<i8")])
+POINT3D_PROPERTIES = np.dtype([
+    ("id", "<u8"), ("xyz", "<f8", 3), ("rgb", "u1", 3), ("error", "<f8"),
+    ("track_length", "<u8")])
+TRACK_ELEMENT = np.dtype([("image_id", "<i4"), ("point2D_idx", "<i4")])
+
+
+def byte_ranges_index(starts, sizes):
+    """Indices of the bytes of the concatenation of the ranges
+    [starts[i], starts[i] + sizes[i])."""
+    offsets = np.cumsum(sizes) - sizes
+    return (np.repeat(starts - offsets, sizes)
+            + np.arange(offsets[-1] + sizes[-1] if len(sizes) else 0))
+
+
+def split_ranges(sizes, chunk_size=1 << 26):
+    """Split consecutive ranges into chunks of about chunk_size bytes, such
+    that the indices of their bytes fit in memory."""
+    ends = np.cumsum(sizes)
+    chunks = []
+    i = 0
+    while i < len(sizes):
+        start = ends[i] - sizes[i]
+        j = max(int(np.searchsorted(ends, start + chunk_size, "right")), i+1)
+        chunks.append(slice(i, j))
+        i = j
+    return chunks
+
+
+def gather_bytes(buffer, starts, sizes):
+    """Concatenate the byte ranges of a buffer in a new array."""
+    starts = np.asarray(starts, np.int64)
+    sizes = np.asarray(sizes, np.int64)
+    output = np.empty(sizes.sum(), np.uint8)
+    offset = 0
+    for chunk in split_ranges(sizes):
+        data = buffer[byte_ranges_index(starts[chunk], sizes[chunk])]
+        output[offset:offset+len(data)] = data
+        offset += len(data)
+    return output
+
+
+def scatter_bytes(buffer, starts, sizes, data):
+    """Inverse of gather_bytes: write the concatenated ranges of data at the
+    given positions of a buffer."""
+    starts = np.asarray(starts, np.int64)
+    sizes = np.asarray(sizes, np.int64)
+    offset = 0
+    for chunk in split_ranges(sizes):
+        index = byte_ranges_index(starts[chunk], sizes[chunk])
+        buffer[index] = data[offset:offset+len(index)]
+        offset += len(index)
+
+
 def read_cameras_text(path):
     """
     see: src/base/reconstruction.cc
@@ -135,24 +195,24 @@ def read_cameras_binary(path_to_model_file):
     """
     cameras = {}
     with open(path_to_model_file, "rb") as fid:
-        num_cameras = read_next_bytes(fid, 8, "Q")[0]
-        for _ in range(num_cameras):
-            camera_properties = read_next_bytes(
-                fid, num_bytes=24, format_char_sequence="iiQQ")
-            camera_id = camera_properties[0]
-            model_id = camera_properties[1]
-            model_name = CAMERA_MODEL_IDS[camera_properties[1]].model_name
-            width = camera_properties[2]
-            height = camera_properties[3]
-            num_params = CAMERA_MODEL_IDS[model_id].num_params
-            params = read_next_bytes(fid, num_bytes=8*num_params,
-                                     format_char_sequence="d"*num_params)
-            cameras[camera_id] = Camera(id=camera_id,
-                                        model=model_name,
-                                        width=width,
-                                        height=height,
-                                        params=np.array(params))
-        assert len(cameras) == num_cameras
+        data = fid.read()
+    num_cameras = struct.unpack_from("<Q", data)[0]
+    offset = 8
+    for _ in range(num_cameras):
+        properties = np.frombuffer(
+            data, CAMERA_PROPERTIES, count=1, offset=offset)[0]
+        offset += CAMERA_PROPERTIES.itemsize
+        camera_id = int(properties["id"])
+        model = CAMERA_MODEL_IDS[int(properties["model_id"])]
+        params = np.frombuffer(
+            data, "<f8", count=model.num_params, offset=offset).copy()
+        offset += 8*model.num_params
+        cameras[camera_id] = Camera(id=camera_id,
+                                    model=model.model_name,
+                                    width=int(properties["width"]),
+                                    height=int(properties["height"]),
+                                    params=params)
+    assert len(cameras) == num_cameras
     return cameras
 
 
@@ -188,8 +248,7 @@ def write_cameras_binary(cameras, path_to_model_file):
                                  cam.width,
                                  cam.height]
             write_next_bytes(fid, camera_properties, "iiQQ")
-            for p in cam.params:
-                write_next_bytes(fid, float(p), "d")
+            fid.write(np.asarray(cam.params, "<f8").tobytes())
     return cameras
 
 
@@ -224,38 +283,86 @@ def read_images_text(path):
     return images
 
 
-def read_images_binary(path_to_model_file):
+def read_images_binary(path_to_model_file, columnar=False):
     """
     see: src/base/reconstruction.cc
         void Reconstruction::ReadImagesBinary(const std::string& path)
         void Reconstruction::WriteImagesBinary(const std::string& path)
+
+    The file is parsed in bulk: only the variable-length records are
+    located in Python, their content is gathered with NumPy. With
+    columnar=True, return the arrays of images_to_columns instead of
+    a dict of Image.
     """
-    images = {}
     with open(path_to_model_file, "rb") as fid:
-        num_reg_images = read_next_bytes(fid, 8, "Q")[0]
-        for _ in range(num_reg_images):
-            binary_image_properties = read_next_bytes(
-                fid, num_bytes=64, format_char_sequence="idddddddi")
-            image_id = binary_image_properties[0]
-            qvec = np.array(binary_image_properties[1:5])
-            tvec = np.array(binary_image_properties[5:8])
-            camera_id = binary_image_properties[8]
-            image_name = ""
-            current_char = read_next_bytes(fid, 1, "c")[0]
-            while current_char != b"\x00":   # look for the ASCII 0 entry
-                image_name += current_char.decode("utf-8")
-                current_char = read_next_bytes(fid, 1, "c")[0]
-            num_points2D = read_next_bytes(fid, num_bytes=8,
-                                           format_char_sequence="Q")[0]
-            x_y_id_s = read_next_bytes(fid, num_bytes=24*num_points2D,
-                                       format_char_sequence="ddq"*num_points2D)
-            xys = np.column_stack([tuple(map(float, x_y_id_s[0::3])),
-                                   tuple(map(float, x_y_id_s[1::3]))])
-            point3D_ids = np.array(tuple(map(int, x_y_id_s[2::3])))
-            images[image_id] = Image(
-                id=image_id, qvec=qvec, tvec=tvec,
-                camera_id=camera_id, name=image_name,
-                xys=xys, point3D_ids=point3D_ids)
+        data = fid.read()
+    num_reg_images = struct.unpack_from("<Q", data)[0]
+    header_size = IMAGE_PROPERTIES.itemsize
+    offsets, names, points2D_offsets, num_points2D = [], [], [], []
+    offset = 8
+    for _ in range(num_reg_images):
+        offsets.append(offset)
+        end = data.index(b"\x00", offset + header_size)  # end of the name
+        names.append(data[offset+header_size:end].decode("utf-8"))
+        num_points2D.append(struct.unpack_from("<Q", data, end + 1)[0])
+        points2D_offsets.append(end + 9)
+        offset = end + 9 + POINT2D.itemsize*num_points2D[-1]
+
+    buffer = np.frombuffer(data, np.uint8)
+    num_points2D = np.array(num_points2D, np.int64)
+    properties = gather_bytes(
+        buffer, offsets, np.full(num_reg_images, header_size)
+    ).view(IMAGE_PROPERTIES)
+    points2D = gather_bytes(
+        buffer, points2D_offsets, POINT2D.itemsize*num_points2D
+    ).view(POINT2D)
+    columns = {
+        "ids": properties["id"].copy(),
+        "qvecs": properties["qvec"].copy(),
+        "tvecs": properties["tvec"].copy(),
+        "camera_ids": properties["camera_id"].copy(),
+        "names": names,
+        "points2D_ptr": np.concatenate([[0], np.cumsum(num_points2D)]),
+        "xys": points2D["xy"].copy(),
+        "point3D_ids": points2D["point3D_id"].copy(),
+    }
+    if columnar:
+        return columns
+    return images_from_columns(columns)
+
+
+def images_to_columns(images):
+    """Convert a dict of Image to contiguous arrays, with the 2D points of
+    all the images concatenated and delimited by points2D_ptr."""
+    images = list(images.values())
+    xys = [np.asarray(img.xys, np.float64).reshape(-1, 2) for img in images]
+    point3D_ids = [np.asarray(img.point3D_ids, np.int64).reshape(-1)
+                   for img in images]
+    return {
+        "ids": np.array([img.id for img in images], np.int32),
+        "qvecs": np.array([img.qvec for img in images],
+                          np.float64).reshape(-1, 4),
+        "tvecs": np.array([img.tvec for img in images],
+                          np.float64).reshape(-1, 3),
+        "camera_ids": np.array([img.camera_id for img in images], np.int32),
+        "names": [img.name for img in images],
+        "points2D_ptr": np.cumsum([0] + [len(x) for x in xys]),
+        "xys": np.concatenate([np.zeros((0, 2))] + xys),
+        "point3D_ids": np.concatenate([np.zeros(0, np.int64)] + point3D_ids),
+    }
+
+
+def images_from_columns(columns):
+    """Inverse of images_to_columns, the arrays of each Image are views."""
+    images = {}
+    ptr = columns["points2D_ptr"].tolist()
+    camera_ids = columns["camera_ids"].tolist()
+    for i, image_id in enumerate(columns["ids"].tolist()):
+        images[image_id] = Image(
+            id=image_id, qvec=columns["qvecs"][i], tvec=columns["tvecs"][i],
+            camera_id=camera_ids[i], name=columns["names"][i],
+            xys=columns["xys"][ptr[i]:ptr[i+1]],
+            point3D_ids=columns["point3D_ids"][ptr[i]:ptr[i+1]])
     return images
 
 
@@ -293,19 +400,42 @@ def write_images_binary(images, path_to_model_file):
         void Reconstruction::ReadImagesBinary(const std::string& path)
         void Reconstruction::WriteImagesBinary(const std::string& path)
     """
+    write_images_columns_binary(images_to_columns(images), path_to_model_file)
+
+
+def write_images_columns_binary(columns, path_to_model_file):
+    """Write the arrays of images_to_columns, laid out in bulk in memory."""
+    num_images = len(columns["ids"])
+    header_size = IMAGE_PROPERTIES.itemsize
+    names = [name.encode("utf-8") + b"\x00" for name in columns["names"]]
+    name_sizes = np.array([len(n) for n in names], np.int64)
+    num_points2D = np.diff(columns["points2D_ptr"]).astype(np.int64)
+
+    properties = np.empty(num_images, IMAGE_PROPERTIES)
+    properties["id"] = columns["ids"]
+    properties["qvec"] = columns["qvecs"]
+    properties["tvec"] = columns["tvecs"]
+    properties["camera_id"] = columns["camera_ids"]
+    points2D = np.empty(len(columns["xys"]), POINT2D)
+    points2D["xy"] = columns["xys"]
+    points2D["point3D_id"] = columns["point3D_ids"]
+
+    record_sizes = header_size + name_sizes + 8 + POINT2D.itemsize*num_points2D
+    offsets = 8 + np.cumsum(record_sizes) - record_sizes
+    buffer = np.empty(8 + record_sizes.sum(), np.uint8)
+    buffer[:8] = np.frombuffer(struct.pack("<Q", num_images), np.uint8)
+    scatter_bytes(buffer, offsets, np.full(num_images, header_size),
+                  properties.view(np.uint8))
+    offsets = offsets + header_size
+    scatter_bytes(buffer, offsets, name_sizes,
+                  np.frombuffer(b"".join(names), np.uint8))
+    offsets = offsets + name_sizes
+    scatter_bytes(buffer, offsets, np.full(num_images, 8),
+                  num_points2D.astype("<u8").view(np.uint8))
+    scatter_bytes(buffer, offsets + 8, POINT2D.itemsize*num_points2D,
+                  points2D.view(np.uint8))
     with open(path_to_model_file, "wb") as fid:
-        write_next_bytes(fid, len(images), "Q")
-        for _, img in images.items():
-            write_next_bytes(fid, img.id, "i")
-            write_next_bytes(fid, img.qvec.tolist(), "dddd")
-            write_next_bytes(fid, img.tvec.tolist(), "ddd")
-            write_next_bytes(fid, img.camera_id, "i")
-            for char in img.name:
-                write_next_bytes(fid, char.encode("utf-8"), "c")
-            write_next_bytes(fid, b"\x00", "c")
-            write_next_bytes(fid, len(img.point3D_ids), "Q")
-            for xy, p3d_id in zip(img.xys, img.point3D_ids):
-                write_next_bytes(fid, [*xy, p3d_id], "ddq")
+        fid.write(buffer)
 
 
 def read_points3D_text(path):
@@ -335,33 +465,87 @@ def read_points3D_text(path):
     return points3D
 
 
-def read_points3D_binary(path_to_model_file):
+def read_points3D_binary(path_to_model_file, columnar=False):
     """
     see: src/base/reconstruction.cc
         void Reconstruction::ReadPoints3DBinary(const std::string& path)
         void Reconstruction::WritePoints3DBinary(const std::string& path)
+
+    The file is parsed in bulk: only the variable-length records are
+    located in Python, their content is gathered with NumPy. With
+    columnar=True, return the arrays of points3D_to_columns instead of
+    a dict of Point3D.
     """
-    points3D = {}
     with open(path_to_model_file, "rb") as fid:
-        num_points = read_next_bytes(fid, 8, "Q")[0]
-        for _ in range(num_points):
-            binary_point_line_properties = read_next_bytes(
-                fid, num_bytes=43, format_char_sequence="QdddBBBd")
-            point3D_id = binary_point_line_properties[0]
-            xyz = np.array(binary_point_line_properties[1:4])
-            rgb = np.array(binary_point_line_properties[4:7])
-            error = np.array(binary_point_line_properties[7])
-            track_length = read_next_bytes(
-                fid, num_bytes=8, format_char_sequence="Q")[0]
-            track_elems = read_next_bytes(
-                fid, num_bytes=8*track_length,
-                format_char_sequence="ii"*track_length)
-            image_ids = np.array(tuple(map(int, track_elems[0::2])))
-            point2D_idxs = np.array(tuple(map(int, track_elems[1::2])))
-            points3D[point3D_id] = Point3D(
-                id=point3D_id, xyz=xyz, rgb=rgb,
-                error=error, image_ids=image_ids,
-                point2D_idxs=point2D_idxs)
+        data = fid.read()
+    num_points = struct.unpack_from("<Q", data)[0]
+    header_size = POINT3D_PROPERTIES.itemsize
+    unpack_track_length = struct.Struct("<Q").unpack_from
+    offsets, track_lengths = [], []
+    offset = 8
+    for _ in range(num_points):
+        offsets.append(offset)
+        track_length = unpack_track_length(data, offset + header_size - 8)[0]
+        track_lengths.append(track_length)
+        offset += header_size + TRACK_ELEMENT.itemsize*track_length
+
+    buffer = np.frombuffer(data, np.uint8)
+    offsets = np.array(offsets, np.int64)
+    track_lengths = np.array(track_lengths, np.int64)
+    properties = gather_bytes(
+        buffer, offsets, np.full(num_points, header_size)
+    ).view(POINT3D_PROPERTIES)
+    track = gather_bytes(
+        buffer, offsets + header_size, TRACK_ELEMENT.itemsize*track_lengths
+    ).view(TRACK_ELEMENT)
+    columns = {
+        "ids": properties["id"].astype(np.int64),
+        "xyz": properties["xyz"].copy(),
+        "rgb": properties["rgb"].copy(),
+        "error": properties["error"].copy(),
+        "track_ptr": np.concatenate([[0], np.cumsum(track_lengths)]),
+        "image_ids": track["image_id"].copy(),
+        "point2D_idxs": track["point2D_idx"].copy(),
+    }
+    if columnar:
+        return columns
+    return points3D_from_columns(columns)
+
+
+def points3D_to_columns(points3D):
+    """Convert a dict of Point3D to contiguous arrays, with the tracks of
+    all the points concatenated and delimited by track_ptr."""
+    points3D = list(points3D.values())
+    image_ids = [np.asarray(p.image_ids, np.int32).reshape(-1)
+                 for p in points3D]
+    point2D_idxs = [np.asarray(p.point2D_idxs, np.int32).reshape(-1)
+                    for p in points3D]
+    return {
+        "ids": np.array([p.id for p in points3D], np.int64),
+        "xyz": np.array([p.xyz for p in points3D], np.float64).reshape(-1, 3),
+        "rgb": np.array([p.rgb for p in points3D], np.uint8).reshape(-1, 3),
+        "error": np.array([p.error for p in points3D], np.float64),
+        "track_ptr": np.cumsum([0] + [len(i) for i in image_ids]),
+        "image_ids": np.concatenate([np.zeros(0, np.int32)] + image_ids),
+        "point2D_idxs": np.concatenate(
+            [np.zeros(0, np.int32)] + point2D_idxs),
+    }
+
+
+def points3D_from_columns(columns):
+    """Inverse of points3D_to_columns, the arrays of each Point3D are views
+    with the same types as those of the former reader."""
+    points3D = {}
+    ptr = columns["track_ptr"].tolist()
+    rgb = columns["rgb"].astype(np.int64)
+    image_ids = columns["image_ids"].astype(np.int64)
+    point2D_idxs = columns["point2D_idxs"].astype(np.int64)
+    for i, point3D_id in enumerate(columns["ids"].tolist()):
+        points3D[point3D_id] = Point3D(
+            id=point3D_id, xyz=columns["xyz"][i], rgb=rgb[i],
+            error=columns["error"][i],
+            image_ids=image_ids[ptr[i]:ptr[i+1]],
+            point2D_idxs=point2D_idxs[ptr[i]:ptr[i+1]])
     return points3D
 
 
@@ -396,17 +580,36 @@ def write_points3D_binary(points3D, path_to_model_file):
         void Reconstruction::ReadPoints3DBinary(const std::string& path)
         void Reconstruction::WritePoints3DBinary(const std::string& path)
     """
+    write_points3D_columns_binary(
+        points3D_to_columns(points3D), path_to_model_file)
+
+
+def write_points3D_columns_binary(columns, path_to_model_file):
+    """Write the arrays of points3D_to_columns, laid out in bulk in memory."""
+    num_points = len(columns["ids"])
+    header_size = POINT3D_PROPERTIES.itemsize
+    track_lengths = np.diff(columns["track_ptr"]).astype(np.int64)
+
+    properties = np.empty(num_points, POINT3D_PROPERTIES)
+    properties["id"] = columns["ids"]
+    properties["xyz"] = columns["xyz"]
+    properties["rgb"] = columns["rgb"]
+    properties["error"] = columns["error"]
+    properties["track_length"] = track_lengths
+    track = np.empty(len(columns["image_ids"]), TRACK_ELEMENT)
+    track["image_id"] = columns["image_ids"]
+    track["point2D_idx"] = columns["point2D_idxs"]
+
+    record_sizes = header_size + TRACK_ELEMENT.itemsize*track_lengths
+    offsets = 8 + np.cumsum(record_sizes) - record_sizes
+    buffer = np.empty(8 + record_sizes.sum(), np.uint8)
+    buffer[:8] = np.frombuffer(struct.pack("<Q", num_points), np.uint8)
+    scatter_bytes(buffer, offsets, np.full(num_points, header_size),
+                  properties.view(np.uint8))
+    scatter_bytes(buffer, offsets + header_size,
+                  TRACK_ELEMENT.itemsize*track_lengths, track.view(np.uint8))
     with open(path_to_model_file, "wb") as fid:
-        write_next_bytes(fid, len(points3D), "Q")
-        for _, pt in points3D.items():
-            write_next_bytes(fid, pt.id, "Q")
-            write_next_bytes(fid, pt.xyz.tolist(), "ddd")
-            write_next_bytes(fid, pt.rgb.tolist(), "BBB")
-            write_next_bytes(fid, pt.error, "d")
-            track_length = pt.image_ids.shape[0]
-            write_next_bytes(fid, track_length, "Q")
-            for image_id, point2D_id in zip(pt.image_ids, pt.point2D_idxs):
-                write_next_bytes(fid, [image_id, point2D_id], "ii")
+        fid.write(buffer)
 
 
 def detect_model_format(path, ext):
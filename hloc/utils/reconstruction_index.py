@@ -0,0 +1,63 @@
+from typing import List
+from pathlib import Path
+import numpy as np
+from scipy.sparse.csgraph import connected_components
+
+from .columnar_model import ColumnarModel, load_columnar_model
+
+
+class ReconstructionIndex:
+    '''Lookup queries on the arrays of a ColumnarModel of a reference
+       reconstruction: the 3D points observed by each image, the positions
+       of the 3D points, and the covisibility graph of the images, which is
+       computed once and stored in the cache of the model.'''
+
+    def __init__(self, model: ColumnarModel):
+        self.model = model
+
+    @classmethod
+    def from_reconstruction(cls, reconstruction) -> 'ReconstructionIndex':
+        '''Build the tables from a pycolmap.Reconstruction.'''
+        return cls(ColumnarModel.from_reconstruction(reconstruction))
+
+    @classmethod
+    def from_model(cls, path: Path) -> 'ReconstructionIndex':
+        '''Load the columnar copy of a COLMAP model, see
+           load_reconstruction_index.'''
+        return cls(load_columnar_model(path, cache=True, covisibility=True))
+
+    def get_points3D_ids(self, image_id: int) -> np.ndarray:
+        '''3D point ids of the keypoints of an image, -1 if not triangulated.'''
+        row = self.model.image_rows(image_id)
+        ptr = self.model.images['points2D_ptr']
+        return np.asarray(
+            self.model.images['point3D_ids'][ptr[row]:ptr[row+1]])
+
+    def num_points3D(self, image_id: int) -> int:
+        return np.count_nonzero(self.get_points3D_ids(image_id) != -1)
+
+    def get_xyz(self, point3D_ids) -> np.ndarray:
+        return np.asarray(
+            self.model.points3D['xyz'][self.model.point3D_rows(point3D_ids)])
+
+    def cluster_images(self, image_ids: List[int]) -> List[List[int]]:
+        '''Split images into the connected components of their covisibility
+           graph, sorted by decreasing size. The images of each component,
+           and the components of equal sizes, keep the order of image_ids.'''
+        image_ids = np.array(list(dict.fromkeys(image_ids)), np.int64)
+        if len(image_ids) == 0:
+            return []
+        rows = self.model.image_rows(image_ids)
+        _, labels = connected_components(
+            self.model.covisibility_graph()[rows][:, rows], directed=False)
+        _, first = np.unique(labels, return_index=True)
+        clusters = [image_ids[labels == labels[i]].tolist()
+                    for i in np.sort(first)]
+        return sorted(clusters, key=len, reverse=True)
+
+
+def load_reconstruction_index(path: Path) -> ReconstructionIndex:
+    '''Load the lookup tables of a COLMAP model from the columnar copy in the
+       model directory, which is written when missing or older than the
+       model.'''
+    return ReconstructionIndex.from_model(path)
@@ -0,0 +1,146 @@
+'''
+Fast access to the 3D scans of the InLoc database images. The scans are
+distributed as MATLAB files next to each cutout, e.g.
+database/cutouts/DUC1/024/DUC_cutout_024_150_0.jpg.mat, and are slow to
+decode. They can be converted once to .npy files that are memory-mapped
+when read, in a directory with the layout:
+    - <image name>.npy: the XYZcut array of the scan of each image,
+    - poses.npz: the alignment of all the scans to the global frame,
+      as a table of 4x4 matrices.
+Converting all the cutouts takes about as much disk space as the decoded
+float64 scans, so the conversion can be restricted to the retrieved images.
+'''
+import argparse
+from typing import Dict, List, Optional
+from collections import OrderedDict
+from pathlib import Path
+import logging
+import numpy as np
+from scipy.io import loadmat
+from tqdm import tqdm
+
+from .parsers import parse_retrieval
+
+logger = logging.getLogger(__name__)
+
+POSES_NAME = 'poses.npz'
+
+
+def get_scans_dir(dataset_dir: Path) -> Path:
+    return Path(dataset_dir, 'database/cutouts_npy')
+
+
+def get_scan_pose_key(rpath: str) -> str:
+    '''Relative path of the alignment file of the scan of an image.'''
+    floor_name, scan_id, image_name = rpath.split('/')[-3:]
+    building_name = image_name[:3]
+    return f'{floor_name}/transformations/{building_name}_trans_{scan_id}.txt'
+
+
+def get_scan_pose(dataset_dir: Path, rpath: str) -> np.ndarray:
+    path = Path(dataset_dir, 'database/alignments', get_scan_pose_key(rpath))
+    with open(path) as f:
+        raw_lines = f.readlines()
+
+    P_after_GICP = np.array([
+        np.fromstring(raw_lines[7], sep=' '),
+        np.fromstring(raw_lines[8], sep=' '),
+        np.fromstring(raw_lines[9], sep=' '),
+        np.fromstring(raw_lines[10], sep=' ')
+    ])
+
+    return P_after_GICP
+
+
+def read_scan_mat(dataset_dir: Path, rpath: str) -> np.ndarray:
+    return loadmat(Path(dataset_dir, rpath + '.mat'))['XYZcut']
+
+
+class ScanLoader:
+    '''Read the scans and alignments of the InLoc database images, from
+       their converted copies if they exist. The scans of the cache_size
+       most recently used images are kept open.'''
+    def __init__(self, dataset_dir: Path, scans_dir: Optional[Path] = None,
+                 cache_size: int = 8):
+        self.dataset_dir = dataset_dir
+        self.scans_dir = scans_dir
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.poses = {}
+        if scans_dir is not None and (scans_dir / POSES_NAME).exists():
+            with np.load(str(scans_dir / POSES_NAME)) as data:
+                self.poses = dict(zip(data['keys'].tolist(), data['poses']))
+
+    def get_scan(self, rpath: str) -> np.ndarray:
+        if rpath in self.cache:
+            self.cache.move_to_end(rpath)
+            return self.cache[rpath]
+        path = None if self.scans_dir is None \
+            else self.scans_dir / (rpath + '.npy')
+        if path is not None and path.exists():
+            # copy-on-write mapping, only the accessed pages are read
+            scan = np.load(str(path), mmap_mode='c')
+        else:
+            scan = read_scan_mat(self.dataset_dir, rpath)
+        if self.cache_size > 0:
+            self.cache[rpath] = scan
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return scan
+
+    def get_pose(self, rpath: str) -> np.ndarray:
+        key = get_scan_pose_key(rpath)
+        if key not in self.poses:
+            self.poses[key] = get_scan_pose(self.dataset_dir, rpath)
+        return self.poses[key]
+
+
+def list_database_images(dataset_dir: Path) -> List[str]:
+    paths = Path(dataset_dir, 'database/cutouts').glob('**/*.jpg.mat')
+    return sorted(str(p.relative_to(dataset_dir))[:-len('.mat')]
+                  for p in paths)
+
+
+def main(dataset_dir: Path, output: Optional[Path] = None,
+         retrieval: Optional[Path] = None, overwrite: bool = False) -> Path:
+    if output is None:
+        output = get_scans_dir(dataset_dir)
+    if retrieval is None:
+        names = list_database_images(dataset_dir)
+    else:
+        names = sorted({r for rs in parse_retrieval(retrieval).values()
+                        for r in rs})
+
+    logger.info(f'Converting the scans of {len(names)} images to {output}...')
+    output.mkdir(exist_ok=True, parents=True)
+    poses: Dict[str, np.ndarray] = {}
+    for name in tqdm(names):
+        path = output / (name + '.npy')
+        if overwrite or not path.exists():
+            path.parent.mkdir(exist_ok=True, parents=True)
+            np.save(str(path), read_scan_mat(dataset_dir, name))
+        key = get_scan_pose_key(name)
+        if key not in poses:
+            poses[key] = get_scan_pose(dataset_dir, name)
+
+    # the poses of the scans converted by previous runs are kept
+    if not overwrite and (output / POSES_NAME).exists():
+        with np.load(str(output / POSES_NAME)) as data:
+            poses = {**dict(zip(data['keys'].tolist(), data['poses'])),
+                     **poses}
+    keys = sorted(poses)
+    np.savez(str(output / POSES_NAME), keys=np.array(keys),
+             poses=np.array([poses[k] for k in keys]).reshape(-1, 4, 4))
+    logger.info('Done!')
+    return output
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset_dir', type=Path, required=True)
+    parser.add_argument('--output', type=Path)
+    parser.add_argument('--retrieval', type=Path,
+                        help='only convert the scans of the retrieved images')
+    parser.add_argument('--overwrite', action='store_true')
+    args = parser.parse_args()
+    main(**args.__dict__)
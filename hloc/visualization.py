@@ -4,9 +4,11 @@ import numpy as np
 import pickle
 import pycolmap
 
+from . import logger
 from .utils.viz import (
         plot_images, plot_keypoints, plot_matches, cm_RdGn, add_text)
 from .utils.io import read_image
+from .utils.loc_logs import LocLogReader, get_logs_path
 
 
 def visualize_sfm_2d(reconstruction, image_dir, color_by='visibility',
@@ -57,11 +59,15 @@ def visualize_loc(results, image_dir, reconstruction=None,
                   selected=[], n=1, seed=0, prefix=None, **kwargs):
     assert image_dir.exists()
 
-    with open(str(results)+'_logs.pkl', 'rb') as f:
-        logs = pickle.load(f)
+    logs_path = get_logs_path(results)
+    if logs_path.exists():
+        logs = LocLogReader(logs_path)
+    else:  # logs written by older versions
+        with open(str(results)+'_logs.pkl', 'rb') as f:
+            logs = pickle.load(f)['loc']
 
     if not selected:
-        queries = list(logs['loc'].keys())
+        queries = list(logs.keys())
         if prefix:
             queries = [q for q in queries if q.startswith(prefix)]
         selected = random.Random(seed).sample(queries, min(n, len(queries)))
@@ -70,9 +76,12 @@ def visualize_loc(results, image_dir, reconstruction=None,
         if not isinstance(reconstruction, pycolmap.Reconstruction):
             reconstruction = pycolmap.Reconstruction(reconstruction)
 
+    # only the logs of the selected queries are read
     for qname in selected:
-        loc = logs['loc'][qname]
+        loc = logs[qname]
         visualize_loc_from_log(image_dir, qname, loc, reconstruction, **kwargs)
+    if isinstance(logs, LocLogReader):
+        logs.close()
 
 
 def visualize_loc_from_log(image_dir, query_name, loc, reconstruction=None,
@@ -80,8 +89,16 @@ def visualize_loc_from_log(image_dir, query_name, loc, reconstruction=None,
 
     q_image = read_image(image_dir / query_name)
     if loc.get('covisibility_clustering', False):
-        # select the first, largest cluster if the localization failed
-        loc = loc['log_clusters'][loc['best_cluster'] or 0]
+        # select the first, largest evaluated cluster if the localization
+        # failed, clusters skipped by the ranked evaluation have no log
+        if loc['best_cluster'] is not None:
+            loc = loc['log_clusters'][loc['best_cluster']]
+        else:
+            logs = [log for log in loc['log_clusters'] if log is not None]
+            if len(logs) == 0:
+                logger.warning(f'No cluster was evaluated for {query_name}.')
+                return
+            loc = logs[0]
 
     inliers = np.array(loc['PnP_ret']['inliers'])
     mkp_q = loc['keypoints_query']
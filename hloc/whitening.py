@@ -4,6 +4,8 @@ import h5py
 import numpy as np
 
 from . import logger
+from .utils.descriptor_store import load_descriptor_store
+from .utils.io import NamesIndex, NAMES_INDEX
 
 
 class PCALayer:
@@ -67,11 +69,16 @@ def main(feature_path, n_components=None, key='global_descriptor'):
 
     white_feature_path = Path(str(feature_path).replace('.h5', '_white.h5'))
 
-    descs = []
-    with h5py.File(str(feature_path), 'r') as fd:
-        for k in fd['db'].keys():
-            descs.append([fd['db'][k][key][:]])
-    descs = np.concatenate(descs, 0)
+    store = load_descriptor_store(feature_path, key)
+    if store is not None:
+        descs = np.asarray(store.get(
+            [n for n in store.names if n.startswith('db/')]))
+    else:
+        descs = []
+        with h5py.File(str(feature_path), 'r') as fd:
+            for k in fd['db'].keys():
+                descs.append([fd['db'][k][key][:]])
+        descs = np.concatenate(descs, 0)
 
     logger.info('Fit PCA Layer')
     pca = PCALayer(n_components=n_components)
@@ -80,15 +87,21 @@ def main(feature_path, n_components=None, key='global_descriptor'):
     logger.info('Store whitened descriptors')
     with h5py.File(str(feature_path), 'r') as fdr:
         with h5py.File(str(white_feature_path), 'w') as fdw:
+            index, names = NamesIndex(fdw), []
+
             def visit_fn(name, obj):
+                if name == NAMES_INDEX:
+                    return
                 if isinstance(obj, h5py.Dataset):
                     value = obj[:]
                     if value.shape[0] > 2:
                         value = pca.transform(value)
                     fdw.create_dataset(name, data=value)
+                    names.append(obj.parent.name.strip('/'))
                 else:
                     fdw.create_group(name)
             fdr.visititems(visit_fn)
+            index.add(names)
 
     return white_feature_path
 
@@ -0,0 +1,127 @@
+'''
+Compare the row-by-row import of keypoints and matches into a COLMAP
+database with the bulk import of hloc.triangulation. Synthetic features
+and matches of a model with 10k images, each paired with 10 others, are
+written to a temporary directory.
+
+    python scripts/benchmark_database_import.py
+    python scripts/benchmark_database_import.py --num_images 1000
+'''
+import argparse
+from pathlib import Path
+import tempfile
+import time
+import numpy as np
+
+from hloc.triangulation import import_features, import_matches
+from hloc.utils.database import COLMAPDatabase
+from hloc.utils.io import get_keypoints, get_matches, H5Writer
+from hloc.utils.parsers import names_to_pair
+
+
+def write_synthetic_data(tmp_dir, num_images, num_pairs_per_image,
+                         num_keypoints, seed=0):
+    rng = np.random.RandomState(seed)
+    names = [f'db/{i:05d}.jpg' for i in range(num_images)]
+    with H5Writer(tmp_dir / 'features.h5') as writer:
+        for name in names:
+            writer.write(name, {'keypoints': (rng.rand(num_keypoints, 2)
+                                              * 1000).astype(np.float32)})
+    pairs = []
+    with H5Writer(tmp_dir / 'matches.h5') as writer:
+        for i in range(num_images):
+            for j in rng.choice(num_images, num_pairs_per_image,
+                                replace=False):
+                if i == j:
+                    continue
+                matches = rng.randint(-1, num_keypoints, num_keypoints)
+                writer.write(names_to_pair(names[i], names[j]), {
+                    'matches0': matches.astype(np.int16),
+                    'matching_scores0': rng.rand(num_keypoints).astype(
+                        np.float16)})
+                pairs.append((names[i], names[j]))
+    with open(tmp_dir / 'pairs.txt', 'w') as f:
+        f.write('\n'.join(' '.join(p) for p in pairs))
+    return {name: i + 1 for i, name in enumerate(names)}
+
+
+def create_database(path, image_ids):
+    db = COLMAPDatabase.connect(path)
+    db.create_tables()
+    db.add_camera(0, 1000, 1000, [500, 500, 500], camera_id=1)
+    for name, image_id in image_ids.items():
+        db.add_image(name, 1, image_id=image_id)
+    db.commit()
+    db.close()
+
+
+def import_per_row(image_ids, database_path, pairs_path, features_path,
+                   matches_path):
+    '''The former import: one statement and one file opening per row.'''
+    db = COLMAPDatabase.connect(database_path)
+    for image_name, image_id in image_ids.items():
+        keypoints = get_keypoints(features_path, image_name)
+        keypoints += 0.5
+        db.add_keypoints(image_id, keypoints)
+    db.commit()
+
+    with open(str(pairs_path), 'r') as f:
+        pairs = [p.split() for p in f.readlines()]
+    matched = set()
+    for name0, name1 in pairs:
+        id0, id1 = image_ids[name0], image_ids[name1]
+        if len({(id0, id1), (id1, id0)} & matched) > 0:
+            continue
+        matched |= {(id0, id1), (id1, id0)}
+        matches, _ = get_matches(matches_path, name0, name1)
+        db.add_matches(id0, id1, matches)
+    db.commit()
+    db.close()
+
+
+def read_tables(path):
+    db = COLMAPDatabase.connect(path)
+    tables = {t: sorted(db.execute(f'SELECT * FROM {t}'))
+              for t in ['keypoints', 'matches']}
+    db.close()
+    return tables
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_images', type=int, default=10000)
+    parser.add_argument('--num_pairs_per_image', type=int, default=10)
+    parser.add_argument('--num_keypoints', type=int, default=1024)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_dir = Path(tmp_dir)
+        print('Writing synthetic features and matches...')
+        image_ids = write_synthetic_data(
+            tmp_dir, args.num_images, args.num_pairs_per_image,
+            args.num_keypoints)
+        features, matches = tmp_dir / 'features.h5', tmp_dir / 'matches.h5'
+        pairs = tmp_dir / 'pairs.txt'
+
+        db_old, db_new = tmp_dir / 'old.db', tmp_dir / 'new.db'
+        create_database(db_old, image_ids)
+        create_database(db_new, image_ids)
+
+        start = time.time()
+        import_per_row(image_ids, db_old, pairs, features, matches)
+        duration_old = time.time() - start
+        print(f'Row-by-row import: {duration_old:.2f}s')
+
+        start = time.time()
+        import_features(image_ids, db_new, features)
+        import_matches(image_ids, db_new, pairs, matches)
+        duration_new = time.time() - start
+        print(f'Bulk import: {duration_new:.2f}s '
+              f'(x{duration_old / duration_new:.1f})')
+
+        assert read_tables(db_old) == read_tables(db_new)
+        print('The databases are identical.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+'''
+Compare the per-pair get_matches with the bulk MatchReader on a match file.
+Without --matches and --pairs, a synthetic file of the size of the Aachen
+localization pairs (1015 queries with 50 retrieved images each) is written
+to a temporary directory.
+
+    python scripts/benchmark_match_reader.py
+    python scripts/benchmark_match_reader.py --matches <matches.h5> \
+        --pairs <pairs.txt>
+'''
+import argparse
+from pathlib import Path
+import tempfile
+import time
+import numpy as np
+import h5py
+
+from hloc.utils.io import get_matches, MatchReader, H5Writer, NAMES_INDEX
+from hloc.utils.parsers import names_to_pair
+
+
+def write_synthetic_matches(path, num_queries, num_retrieved, num_keypoints,
+                            num_db=4328, seed=0):
+    rng = np.random.RandomState(seed)
+    pairs = []
+    with H5Writer(path) as writer:
+        for q in range(num_queries):
+            for r in rng.choice(num_db, num_retrieved, replace=False):
+                name0, name1 = f'query/{q:04d}.jpg', f'db/{r:04d}.jpg'
+                matches = rng.randint(-1, num_keypoints, num_keypoints)
+                writer.write(names_to_pair(name0, name1), {
+                    'matches0': matches.astype(np.int16),
+                    'matching_scores0': rng.rand(num_keypoints).astype(
+                        np.float16)})
+                pairs.append((name0, name1))
+    return pairs
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--matches', type=Path)
+    parser.add_argument('--pairs', type=Path)
+    parser.add_argument('--num_queries', type=int, default=1015)
+    parser.add_argument('--num_retrieved', type=int, default=50)
+    parser.add_argument('--num_keypoints', type=int, default=4096)
+    parser.add_argument('--without_index', action='store_true',
+                        help='remove the names index of the synthetic file, '
+                        'as in files written by older versions')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if args.matches is None:
+            matches_path = Path(tmp_dir, 'matches.h5')
+            print('Writing a synthetic match file...')
+            pairs = write_synthetic_matches(
+                matches_path, args.num_queries, args.num_retrieved,
+                args.num_keypoints)
+            if args.without_index:
+                with h5py.File(str(matches_path), 'a') as fd:
+                    del fd[NAMES_INDEX]
+        else:
+            matches_path = args.matches
+            with open(args.pairs, 'r') as f:
+                pairs = [tuple(p.split()) for p in f.read().rstrip('\n')
+                         .split('\n')]
+        print(f'Reading the matches of {len(pairs)} pairs.')
+
+        start = time.time()
+        expected = [get_matches(matches_path, *p) for p in pairs]
+        duration_old = time.time() - start
+        print(f'get_matches: {duration_old:.2f}s')
+
+        start = time.time()
+        with MatchReader(matches_path) as reader:
+            results = reader.get_many(pairs)
+        duration_new = time.time() - start
+        print(f'MatchReader.get_many: {duration_new:.2f}s '
+              f'(x{duration_old / duration_new:.1f})')
+
+        for (m0, s0), (m1, s1) in zip(expected, results):
+            assert np.array_equal(m0, m1) and np.array_equal(s0, s1)
+        print('The matches are identical.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+'''
+Compare the former per-element parsing of binary COLMAP models with the
+bulk reader and writer of hloc.utils.read_write_model. Without --model,
+a synthetic model with 1000 images and 1M 3D points is written to a
+temporary directory.
+
+    python scripts/benchmark_read_write_model.py
+    python scripts/benchmark_read_write_model.py --model <path/to/sfm>
+'''
+import argparse
+from pathlib import Path
+import tempfile
+import time
+import numpy as np
+
+from hloc.utils.read_write_model import (
+    Camera, Image, Point3D, read_next_bytes, write_next_bytes,
+    read_images_binary, read_points3D_binary, write_images_binary,
+    write_points3D_binary, write_model)
+
+
+def read_images_binary_per_element(path):
+    images = {}
+    with open(path, "rb") as fid:
+        num_reg_images = read_next_bytes(fid, 8, "Q")[0]
+        for _ in range(num_reg_images):
+            props = read_next_bytes(fid, 64, "idddddddi")
+            image_name = ""
+            current_char = read_next_bytes(fid, 1, "c")[0]
+            while current_char != b"\x00":
+                image_name += current_char.decode("utf-8")
+                current_char = read_next_bytes(fid, 1, "c")[0]
+            num_points2D = read_next_bytes(fid, 8, "Q")[0]
+            x_y_id_s = read_next_bytes(fid, 24*num_points2D,
+                                       "ddq"*num_points2D)
+            xys = np.column_stack([tuple(map(float, x_y_id_s[0::3])),
+                                   tuple(map(float, x_y_id_s[1::3]))])
+            point3D_ids = np.array(tuple(map(int, x_y_id_s[2::3])))
+            images[props[0]] = Image(
+                id=props[0], qvec=np.array(props[1:5]),
+                tvec=np.array(props[5:8]), camera_id=props[8],
+                name=image_name, xys=xys, point3D_ids=point3D_ids)
+    return images
+
+
+def read_points3D_binary_per_element(path):
+    points3D = {}
+    with open(path, "rb") as fid:
+        num_points = read_next_bytes(fid, 8, "Q")[0]
+        for _ in range(num_points):
+            props = read_next_bytes(fid, 43, "QdddBBBd")
+            track_length = read_next_bytes(fid, 8, "Q")[0]
+            track_elems = read_next_bytes(fid, 8*track_length,
+                                          "ii"*track_length)
+            points3D[props[0]] = Point3D(
+                id=props[0], xyz=np.array(props[1:4]),
+                rgb=np.array(props[4:7]), error=np.array(props[7]),
+                image_ids=np.array(tuple(map(int, track_elems[0::2]))),
+                point2D_idxs=np.array(tuple(map(int, track_elems[1::2]))))
+    return points3D
+
+
+def write_images_binary_per_element(images, path):
+    with open(path, "wb") as fid:
+        write_next_bytes(fid, len(images), "Q")
+        for _, img in images.items():
+            write_next_bytes(fid, img.id, "i")
+            write_next_bytes(fid, img.qvec.tolist(), "dddd")
+            write_next_bytes(fid, img.tvec.tolist(), "ddd")
+            write_next_bytes(fid, img.camera_id, "i")
+            for char in img.name:
+                write_next_bytes(fid, char.encode("utf-8"), "c")
+            write_next_bytes(fid, b"\x00", "c")
+            write_next_bytes(fid, len(img.point3D_ids), "Q")
+            for xy, p3d_id in zip(img.xys, img.point3D_ids):
+                write_next_bytes(fid, [*xy, p3d_id], "ddq")
+
+
+def write_points3D_binary_per_element(points3D, path):
+    with open(path, "wb") as fid:
+        write_next_bytes(fid, len(points3D), "Q")
+        for _, pt in points3D.items():
+            write_next_bytes(fid, pt.id, "Q")
+            write_next_bytes(fid, pt.xyz.tolist(), "ddd")
+            write_next_bytes(fid, pt.rgb.tolist(), "BBB")
+            write_next_bytes(fid, pt.error, "d")
+            write_next_bytes(fid, pt.image_ids.shape[0], "Q")
+            for image_id, point2D_id in zip(pt.image_ids, pt.point2D_idxs):
+                write_next_bytes(fid, [image_id, point2D_id], "ii")
+
+
+def write_synthetic_model(path, num_images, num_points, num_keypoints,
+                          seed=0):
+    rng = np.random.RandomState(seed)
+    point3D_ids = rng.randint(0, num_points, (num_images, num_keypoints))
+    point3D_ids[rng.rand(num_images, num_keypoints) < 0.5] = -1
+    images = {}
+    for i in range(num_images):
+        images[i+1] = Image(
+            id=i+1, qvec=rng.rand(4), tvec=rng.rand(3), camera_id=1,
+            name=f'db/{i:05d}.jpg', xys=rng.rand(num_keypoints, 2) * 1000,
+            point3D_ids=point3D_ids[i])
+    image_idxs, point2D_idxs = np.nonzero(point3D_ids != -1)
+    ids = point3D_ids[image_idxs, point2D_idxs]
+    order = np.argsort(ids, kind='stable')
+    ptr = np.searchsorted(ids[order], np.arange(num_points + 1))
+    points3D = {}
+    for i in range(num_points):
+        track = order[ptr[i]:ptr[i+1]]
+        points3D[i] = Point3D(
+            id=i, xyz=rng.rand(3), rgb=rng.randint(0, 256, 3),
+            error=np.array(rng.rand()), image_ids=image_idxs[track] + 1,
+            point2D_idxs=point2D_idxs[track])
+    cameras = {1: Camera(id=1, model='SIMPLE_RADIAL', width=1600,
+                         height=1200, params=np.array([1e3, 8e2, 6e2, 0]))}
+    write_model(cameras, images, points3D, str(path))
+
+
+def measure(name, func, *args):
+    start = time.time()
+    output = func(*args)
+    duration = time.time() - start
+    print(f'{name}: {duration:.2f}s')
+    return output, duration
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', type=Path)
+    parser.add_argument('--num_images', type=int, default=1000)
+    parser.add_argument('--num_points', type=int, default=1000000)
+    parser.add_argument('--num_keypoints', type=int, default=4096)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_dir = Path(tmp_dir)
+        model = args.model
+        if model is None:
+            print('Writing a synthetic model...')
+            model = tmp_dir
+            write_synthetic_model(model, args.num_images, args.num_points,
+                                  args.num_keypoints)
+
+        for name, read_old, read_new, write_old, write_new in [
+                ('images.bin', read_images_binary_per_element,
+                 read_images_binary, write_images_binary_per_element,
+                 write_images_binary),
+                ('points3D.bin', read_points3D_binary_per_element,
+                 read_points3D_binary, write_points3D_binary_per_element,
+                 write_points3D_binary)]:
+            expected, t_old = measure(
+                f'{name} per element read', read_old, model / name)
+            data, t_new = measure(f'{name} bulk read', read_new, model / name)
+            _, t_columnar = measure(f'{name} bulk columnar read',
+                                    read_new, model / name, True)
+            print(f'x{t_old / t_new:.1f}, columnar x{t_old / t_columnar:.1f}')
+            for a, b in zip(expected.values(), data.values()):
+                assert all(np.array_equal(x, y) for x, y in zip(a, b))
+
+            _, t_old = measure(f'{name} per element write', write_old,
+                               expected, tmp_dir / f'old_{name}')
+            _, t_new = measure(f'{name} bulk write', write_new,
+                               expected, tmp_dir / f'new_{name}')
+            print(f'x{t_old / t_new:.1f}')
+            assert (tmp_dir / f'old_{name}').read_bytes() == \
+                (tmp_dir / f'new_{name}').read_bytes()
+        print('The outputs are identical.')
+
+
+if __name__ == '__main__':
+    main()
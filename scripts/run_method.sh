@@ -21,10 +21,14 @@ elif [[ $REFINEMENT == "MS" ]]; then
     python -m hloc.pipelines.Aachen.pipeline --outputs $OUTPUTS --retrieval $METHOD --im_size $IM_SIZE --multiscale '[2**(1/2), 1, 1/2**(1/2)]'
 elif [[ $REFINEMENT == "QE" ]]; then
     python -m hloc.pipelines.Aachen.pipeline --outputs $OUTPUTS --retrieval $METHOD --im_size $IM_SIZE --query_expansion 5
+elif [[ $REFINEMENT == "aQE" ]]; then
+    python -m hloc.pipelines.Aachen.pipeline --outputs $OUTPUTS --retrieval $METHOD --im_size $IM_SIZE --query_expansion 5 --alpha 3
+elif [[ $REFINEMENT == "DBA" ]]; then
+    python -m hloc.pipelines.Aachen.pipeline --outputs $OUTPUTS --retrieval $METHOD --im_size $IM_SIZE --dba 5 --alpha 3
 elif [[ $REFINEMENT == "TD" ]]; then
     python -m hloc.pipelines.Aachen.pipeline --outputs $OUTPUTS --retrieval $METHOD --im_size $IM_SIZE --use_todaygan
 else
     echo "Error: refinement does not exists. Please, select one of the available refinements."
-    echo "Available refinements: none, W, MS, QE, TD"
+    echo "Available refinements: none, W, MS, QE, aQE, DBA, TD"
     exit
 fi
\ No newline at end of file
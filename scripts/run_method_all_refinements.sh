@@ -7,4 +7,6 @@ IM_SIZE=$3
 bash scripts/run_method.sh $OUTPUTS $METHOD $IM_SIZE W
 bash scripts/run_method.sh $OUTPUTS $METHOD $IM_SIZE MS
 bash scripts/run_method.sh $OUTPUTS $METHOD $IM_SIZE QE
+bash scripts/run_method.sh $OUTPUTS $METHOD $IM_SIZE aQE
+bash scripts/run_method.sh $OUTPUTS $METHOD $IM_SIZE DBA
 bash scripts/run_method.sh $OUTPUTS $METHOD $IM_SIZE TD
@@ -0,0 +1,57 @@
+import pickle
+import numpy as np
+import pytest
+
+h5py = pytest.importorskip('h5py')
+pytest.importorskip('pycolmap')
+from hloc.utils.loc_logs import LocLogWriter, LocLogReader  # noqa: E402
+
+
+def make_query_log(num_matches=2000, num_db=20, seed=0):
+    '''A log of localize_sfm for a query with num_matches matches.'''
+    rng = np.random.RandomState(seed)
+    mkp_idxs = rng.randint(0, 4096, num_matches).tolist()
+    mp3d_ids = rng.randint(0, 10**6, num_matches).tolist()
+    mkp_to_3D_to_db = [(j, rng.randint(0, num_db, rng.randint(1, 4)).tolist())
+                       for j in mp3d_ids]
+    ret = {
+        'success': True,
+        'qvec': rng.rand(4),
+        'tvec': rng.rand(3),
+        'num_inliers': num_matches // 4,
+        'inliers': rng.rand(num_matches) > 0.75,
+        'camera': {'model': 'SIMPLE_RADIAL', 'width': 1600, 'height': 1200,
+                   'params': rng.rand(4)},
+    }
+    return {
+        'db': list(range(num_db)),
+        'PnP_ret': ret,
+        'keypoints_query': rng.rand(num_matches, 2),
+        'points3D_ids': mp3d_ids,
+        'points3D_xyz': None,
+        'num_matches': num_matches,
+        'keypoint_index_to_db': (mkp_idxs, mkp_to_3D_to_db),
+        'covisibility_clustering': False,
+        'latency': 0.1,
+    }
+
+
+def test_query_log_layout(tmp_path):
+    log = make_query_log()
+    path = tmp_path / 'logs.h5'
+    with LocLogWriter(path) as writer:
+        writer.write('query.jpg', log)
+
+    names = []
+    with h5py.File(str(path), 'r') as fd:
+        fd['query.jpg'].visit(names.append)
+    # the per-match data is stored in a few flat datasets
+    assert len(names) < 50
+    assert path.stat().st_size < 4 * len(pickle.dumps(log))
+
+    with LocLogReader(path) as reader:
+        restored = reader['query.jpg']
+    assert restored['keypoint_index_to_db'] == log['keypoint_index_to_db']
+    assert restored['points3D_ids'] == log['points3D_ids']
+    assert np.array_equal(restored['PnP_ret']['inliers'],
+                          log['PnP_ret']['inliers'])